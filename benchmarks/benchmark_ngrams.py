@@ -1,5 +1,5 @@
 from benchmark import benchmark
-from ngrams import NgramData
+from ngrams import NgramData, DenseNgramData
 from benchmark_letters_only import string_translate_defaultdict as letters_only
 
 ###############################################################################
@@ -127,7 +127,7 @@ if __name__ == "__main__":
     with open("sample.txt", "r") as f:
         text = f.read().strip()
     # list of the instances to test
-    instances = [Current(4), InlineDictGet(4), DictKeyError(4), LocalVarDictKeyError(4), LocalVarDictKeyErrorLettersOnly(4)]
+    instances = [Current(4), InlineDictGet(4), DictKeyError(4), LocalVarDictKeyError(4), LocalVarDictKeyErrorLettersOnly(4), DenseNgramData(4)]
     # test the instances
     correct = Current(4).rate("Hello World")
     for inst in instances:
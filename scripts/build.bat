@@ -7,8 +7,10 @@ REM activate python virtual environment
 CALL env\Scripts\activate.bat
 REM change to src dir
 cd src
+REM precompile the binary ngram caches
+python ngrams.py
 REM build exe
-pyinstaller main.py -F -w --workpath ..\build\ --distpath ..\build\ --add-data ngram_data\*GRAM.txt;ngram_data\
+pyinstaller main.py -F -w --workpath ..\build\ --distpath ..\build\ --add-data ngram_data\*GRAM.txt;ngram_data\ --add-data ngram_data\WORDS.txt;ngram_data\ --add-data ngram_data\*.bin;ngram_data\
 REM delete main.spec
 del main.spec 2> nul
 REM wait for user to close window
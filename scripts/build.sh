@@ -8,7 +8,9 @@ rm -r build > /dev/null 2>&1
 source env/bin/activate
 # change to src dir
 cd src
+# precompile the binary ngram caches
+python ngrams.py
 # build
-pyinstaller main.py -F -w --workpath "../build/" --distpath "../build/dist/" --add-data "ngram_data/*GRAM.txt:ngram_data/"
+pyinstaller main.py -F -w --workpath "../build/" --distpath "../build/dist/" --add-data "ngram_data/*GRAM.txt:ngram_data/" --add-data "ngram_data/WORDS.txt:ngram_data/" --add-data "ngram_data/*.bin:ngram_data/"
 # delete main.spec
 rm main.spec 2>&1
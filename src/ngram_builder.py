@@ -0,0 +1,183 @@
+import argparse
+import multiprocessing
+import os
+
+import numpy
+
+from ngrams import build_ngram_cache, index_digits, ngram_indexes
+from utilities import letters_only_uppercase_bytes
+
+# files are split into ranges of this many bytes, so large files are counted by several processes
+RANGE_SIZE = 2 ** 26
+# the number of bytes each process reads at a time
+READ_SIZE = 2 ** 22
+# counts of patterns longer than this are stored sparsely as (indexes, counts) instead of an array of every pattern
+MAX_DENSE_N = 4
+
+
+def merge_counts(indexes_list, counts_list):
+    """Combines lists of (indexes, counts) arrays, adding together the counts of the same index. Returns (indexes, counts) sorted by index"""
+    indexes = numpy.concatenate(indexes_list)
+    counts = numpy.concatenate(counts_list)
+    if len(indexes) == 0:
+        return indexes.astype(numpy.int64), counts.astype(numpy.int64)
+    # sort by index so the same indexes are next to each other
+    order = numpy.argsort(indexes, kind="mergesort")
+    indexes = indexes[order]
+    counts = counts[order]
+    # add together the counts of each run of the same index
+    starts = numpy.flatnonzero(numpy.concatenate(([True], indexes[1:] != indexes[:-1])))
+    return indexes[starts].astype(numpy.int64), numpy.add.reduceat(counts, starts).astype(numpy.int64)
+
+
+class NgramCounter:
+    """Counts the 1 to max_n long patterns in letters which are fed to it in chunks"""
+
+    def __init__(self, max_n):
+        self.max_n = max_n
+        # the letter codes at the end of the previous chunk, so patterns spanning two chunks are counted
+        self.carry = numpy.empty(0, dtype=numpy.intp)
+        # short patterns are counted in an array of every possible pattern, long patterns as lists of the (indexes, counts)
+        # of each chunk, which are only merged once all the chunks have been fed
+        self.dense_counts = {}
+        self.sparse_counts = {}
+        for n in range(1, max_n + 1):
+            if n <= MAX_DENSE_N:
+                self.dense_counts[n] = numpy.zeros(26 ** n, dtype=numpy.int64)
+            else:
+                self.sparse_counts[n] = ([numpy.empty(0, dtype=numpy.int64)], [numpy.empty(0, dtype=numpy.int64)])
+
+    def feed(self, letters, tail=False):
+        """Count the patterns ending in the next chunk of letters (uppercase ascii bytes).
+        If tail is True, only the patterns which start in the previous chunks are counted"""
+        codes = numpy.frombuffer(letters, dtype=numpy.uint8).astype(numpy.intp) - 65
+        buffer = numpy.concatenate((self.carry, codes))
+        carried = len(self.carry)
+        for n in range(1, self.max_n + 1):
+            if len(buffer) < n:
+                continue
+            # patterns which start before carried - n + 1 were counted with the previous chunk
+            indexes = ngram_indexes(buffer, n)[max(0, carried - n + 1):]
+            if tail:
+                # only the patterns which start in the carried letters
+                indexes = indexes[:carried - max(0, carried - n + 1)]
+            self.add(n, indexes)
+        # keep the letters which could still start a pattern
+        self.carry = buffer[max(0, len(buffer) - self.max_n + 1):]
+
+    def add(self, n, indexes):
+        """Add the pattern indexes to the counts for n"""
+        if n in self.dense_counts:
+            self.dense_counts[n] += numpy.bincount(indexes, minlength=26 ** n)
+        else:
+            unique_indexes, counts = numpy.unique(indexes, return_counts=True)
+            indexes_list, counts_list = self.sparse_counts[n]
+            indexes_list.append(unique_indexes)
+            counts_list.append(counts)
+
+    def results(self):
+        """Returns {n: (indexes, counts)} containing only the patterns which occurred"""
+        results = {}
+        for n, (indexes_list, counts_list) in self.sparse_counts.items():
+            # merge the counts of every chunk at once instead of sorting the running total again after each chunk
+            indexes, counts = merge_counts(indexes_list, counts_list)
+            self.sparse_counts[n] = ([indexes], [counts])
+            results[n] = (indexes, counts)
+        for n, counts in self.dense_counts.items():
+            indexes = numpy.flatnonzero(counts)
+            results[n] = (indexes.astype(numpy.int64), counts[indexes])
+        return results
+
+
+def count_range(task):
+    """Counts the patterns starting in a range of bytes of a file. Entry point for the worker processes"""
+    path, start, end, max_n = task
+    counter = NgramCounter(max_n)
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            data = f.read(min(READ_SIZE, end - position))
+            if not data:
+                break
+            position += len(data)
+            counter.feed(letters_only_uppercase_bytes(data))
+        # read past the end of the range to count the patterns which start at the end of it
+        tail = b""
+        while len(tail) < max_n - 1:
+            data = f.read(4096)
+            if not data:
+                break
+            tail += letters_only_uppercase_bytes(data)
+        counter.feed(tail[:max_n - 1], tail=True)
+    return counter.results()
+
+
+def get_tasks(input_dir, max_n):
+    """Returns a list of (path, start, end, max_n) for every range of every file in the input directory"""
+    tasks = []
+    for root, dirs, filenames in os.walk(input_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            size = os.path.getsize(path)
+            for start in range(0, size, RANGE_SIZE):
+                tasks.append((path, start, min(size, start + RANGE_SIZE), max_n))
+    return tasks
+
+
+def count_corpus(input_dir, max_n=5, processes=None, progress=None):
+    """Counts the 1 to max_n long patterns in every file in the input directory using a pool of processes.
+    Returns {n: (indexes, counts)} with the indexes sorted. If progress is given it is called with (ranges counted,
+    number of ranges) each time a range is counted"""
+    totals = {n: (numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)) for n in range(1, max_n + 1)}
+    tasks = get_tasks(input_dir, max_n)
+    with multiprocessing.Pool(processes=processes) as pool:
+        # map: each process counts a range of a file. reduce: merge the counts as they arrive
+        for i, results in enumerate(pool.imap_unordered(count_range, tasks), start=1):
+            for n, (indexes, counts) in results.items():
+                total_indexes, total_counts = totals[n]
+                totals[n] = merge_counts([total_indexes, indexes], [total_counts, counts])
+            if progress is not None:
+                progress(i, len(tasks))
+    return totals
+
+
+def write_ngram_file(path, n, indexes, counts):
+    """Writes counts in the NGRAM.txt format, most common pattern first"""
+    order = numpy.argsort(-counts, kind="mergesort")
+    letters = numpy.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+    keys = ["".join(key) for key in letters[index_digits(indexes[order], n)]]
+    with open(path, "w") as f:
+        for key, count in zip(keys, counts[order].tolist()):
+            f.write("{} {}\n".format(key, count))
+
+
+def build_ngram_data(input_dir, output_dir, max_n=5, processes=None, progress=None):
+    """Counts the patterns in the input directory and writes the NGRAM.txt files and binary caches to the output directory.
+    progress is passed to count_corpus(). Returns the paths of the binary caches"""
+    os.makedirs(output_dir, exist_ok=True)
+    totals = count_corpus(input_dir, max_n, processes, progress)
+    cache_paths = []
+    for n, (indexes, counts) in totals.items():
+        if len(indexes) == 0:
+            # the corpus is shorter than n letters
+            continue
+        write_ngram_file(os.path.join(output_dir, "{}GRAM.txt".format(n)), n, indexes, counts)
+        cache_paths.append(build_ngram_cache(n, output_dir))
+    return cache_paths
+
+
+def print_progress(counted, total):
+    """Prints how many ranges of the corpus have been counted"""
+    print("Counted {} out of {} ranges".format(counted, total))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build ngram data from a directory of text files")
+    parser.add_argument("input_dir", help="directory containing the text files")
+    parser.add_argument("output_dir", help="directory to write the NGRAM.txt and binary cache files to")
+    parser.add_argument("--max-n", type=int, default=5, help="the longest patterns to count (default 5)")
+    parser.add_argument("--processes", type=int, default=None, help="the number of worker processes (default: one per cpu)")
+    args = parser.parse_args()
+    for cache_path in build_ngram_data(args.input_dir, args.output_dir, args.max_n, args.processes, print_progress):
+        print("Built {}".format(cache_path))
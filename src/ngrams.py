@@ -1,21 +1,49 @@
+import hashlib
 import math
 import os
+import struct
+import sys
+import tempfile
+from collections import OrderedDict
+import numpy
 from utilities import letters_only_uppercase
 
 
 # get the ngram data folder
 NGRAM_DATA_PATH = os.path.dirname(os.path.realpath(__file__)) + "/ngram_data/"
-# cache ngram data so it does not have to be reloaded every time
-_cached_ngram_data = {}
+# the binary cache files start with a header, followed by the arrays of the ngram data (see ArrayNgramData).
+# header: magic, version, n, source file size, source file modification time, source file sha1, score_other, avg
+CACHE_HEADER = struct.Struct("<4sIIQq20sdd")
+CACHE_VERSION = 1
+# ngram data with more possible patterns than this is stored in a SparseNgramData instead of a DenseNgramData
+MAX_DENSE_TABLE_SIZE = 26 ** 4
+# the longest patterns whose base 26 indexes fit in a 64 bit integer. 26^14 is more than 2^63
+MAX_N = 13
+# the maximum number of letters rate_many() rates in one numpy operation
+RATE_MANY_BATCH_SIZE = 2 ** 22
+# the number of patterns rate_bounded() rates before the first check, this doubles after every check
+RATE_BOUNDED_FIRST_CHUNK = 256
+# how many standard errors the running estimate of rate_bounded(estimate=True) must be past the threshold before aborting
+RATE_BOUNDED_CONFIDENCE = 4
+# the number of characters rate_stream() reads from a file at a time
+STREAM_CHUNK_SIZE = 2 ** 20
+# the weight of the score of each pattern length used by InterpolatedNgramData
+INTERPOLATION_WEIGHTS = {1: 0.1, 2: 0.2, 3: 0.3, 4: 0.4}
+# texts shorter than this are rated by InterpolatedNgramData in SolverProcess, as 4grams alone are unreliable
+INTERPOLATED_MAX_LENGTH = 40
+# the binary cache files are stored here if the ngram data folder is read only
+NGRAM_CACHE_FALLBACK_PATH = os.path.join(tempfile.gettempdir(), "ngram_cache") + "/"
+# the name of the corpus in NGRAM_DATA_PATH
+DEFAULT_CORPUS = "english"
 
 
 class NgramData:
 
-    def __init__(self, n):
+    def __init__(self, n, data_path=None):
         self.n = n
 
         # check if the path exists
-        path = NGRAM_DATA_PATH + str(n) + "GRAM.txt"
+        path = _source_path(n, data_path)
         if not os.path.isfile(path):
             raise ValueError("Ngram data does not exist for n={}".format(n))
         # read data
@@ -43,6 +71,14 @@ class NgramData:
         # calculate the average. The closer text is to this, the better
         self.avg = sum_frequency_times_score / total_count
 
+    def memory_size(self):
+        """Returns the approximate number of bytes used to store the scores"""
+        if not hasattr(self, "_memory_size"):
+            self._memory_size = sys.getsizeof(self.scores)
+            for key, score in self.scores.items():
+                self._memory_size += sys.getsizeof(key) + sys.getsizeof(score)
+        return self._memory_size
+
     def get_score(self, key):
         """Get the score for a specific key"""
         # check the specified key is length n
@@ -76,15 +112,872 @@ class NgramData:
         return abs(self.avg - average_score)
 
 
-def get_ngram_data(n):
-    """Returns the instance of NgramData containing Ngrams of length n. Caches the instances so the data doesn't have to be repeatedly loaded from disk"""
-    global _cached_ngram_data
-    if n not in _cached_ngram_data:
-        _cached_ngram_data[n] = NgramData(n)
-    return _cached_ngram_data[n]
+def text_to_codes(text):
+    """Converts the letters in the text into a numpy array of letter indexes (A=0, B=1, ..., Z=25). Non letter characters are stripped"""
+    letters = letters_only_uppercase(text)
+    # encode as ascii so numpy can view the characters as bytes without a python loop
+    codes = numpy.frombuffer(letters.encode("ascii"), dtype=numpy.uint8)
+    # convert from character codes to letter indexes, using intp so the
+    # indexes can be multiplied by powers of 26 without overflowing
+    return codes.astype(numpy.intp) - 65
 
 
-def rate(text, n=4):
-    """Shortcut for get_ngram_data(n).rate(text)"""
-    ngram_data = get_ngram_data(n)
+def check_n(n):
+    """Raises a ValueError if the indexes of n long patterns would overflow a 64 bit integer"""
+    if n > MAX_N:
+        raise ValueError("n={} is too long, the indexes of patterns longer than {} don't fit in 64 bits".format(n, MAX_N))
+
+
+def ngram_indexes(codes, n):
+    """Returns the base 26 index of every n long pattern in an array of letter codes.
+    If codes is 2D the indexes of the patterns in each row are returned"""
+    check_n(n)
+    # the first pattern starts at 0 and the last starts at len(codes) - n
+    num_patterns = codes.shape[-1] - n + 1
+    indexes = numpy.array(codes[..., :num_patterns], dtype=numpy.intp)
+    # rolling index: shift the previous letters up one base 26 digit and add the next letter
+    for i in range(1, n):
+        indexes *= 26
+        indexes += codes[..., i:i + num_patterns]
+    return indexes
+
+
+def index_digits(indexes, n):
+    """Splits base 26 pattern indexes back into their letter codes. Returns an array of shape (len(indexes), n)"""
+    digits = numpy.empty((len(indexes), n), dtype=numpy.intp)
+    remaining = numpy.array(indexes, dtype=numpy.intp)
+    # the last letter is the lowest digit
+    for i in range(n - 1, -1, -1):
+        digits[:, i] = remaining % 26
+        remaining //= 26
+    return digits
+
+
+def mapping_to_codes(mapping):
+    """Converts a substitution mapping into an array where array[cipher letter code] = output letter code.
+    mapping can either be a dictionary of letter:letter in the same format as substitution() (missing letters are
+    left unchanged) or a sequence of 26 letter codes"""
+    if isinstance(mapping, dict):
+        codes = numpy.arange(26, dtype=numpy.intp)
+        for key, value in mapping.items():
+            codes[ord(key.upper()) - 65] = ord(value.upper()) - 65
+        return codes
+    codes = numpy.asarray(mapping, dtype=numpy.intp)
+    if codes.shape != (26,):
+        raise ValueError("Mapping must contain 26 letter codes")
+    return codes
+
+
+class NgramCounts:
+    """Histogram of the n long patterns in a text, storing each unique pattern and the number of times it occurs.
+    Used to rate relabelings of the same text without going over the whole text again. Scores rated from the histogram
+    equal rating the text up to floating point rounding"""
+
+    def __init__(self, indexes, counts, n):
+        self.n = n
+        # base 26 index of each unique pattern, and how many times it occurs
+        self.indexes = numpy.asarray(indexes, dtype=numpy.intp)
+        self.counts = numpy.asarray(counts, dtype=numpy.int64)
+        # the total number of patterns in the text
+        self.total = int(self.counts.sum())
+        # the letter codes of each unique pattern, used to relabel the patterns
+        self.digits = index_digits(self.indexes, n)
+
+    @classmethod
+    def from_codes(cls, codes, n):
+        """Count the patterns in an array of letter codes"""
+        if len(codes) < n:
+            return cls([], [], n)
+        indexes, counts = numpy.unique(ngram_indexes(codes, n), return_counts=True)
+        return cls(indexes, counts, n)
+
+    @classmethod
+    def from_text(cls, text, n):
+        """Count the patterns in a text. Non letter characters are stripped, the same as rate()"""
+        return cls.from_codes(text_to_codes(text), n)
+
+    @classmethod
+    def from_dict(cls, counts):
+        """Make from a dictionary of pattern:count"""
+        if len(counts) == 0:
+            raise ValueError("Cannot work out n from empty counts")
+        n = len(next(iter(counts)))
+        indexes = ngram_indexes(text_to_codes("".join(counts.keys())), n)[::n]
+        return cls(indexes, list(counts.values()), n)
+
+    def to_dict(self):
+        """Returns a dictionary of pattern:count"""
+        patterns = ("".join(chr(65 + code) for code in digits) for digits in self.digits)
+        return dict(zip(patterns, self.counts.tolist()))
+
+    def mapped_indexes(self, mapping_codes, selection=None):
+        """Returns the base 26 index of each unique pattern after its letters have been relabeled by mapping_codes.
+        If selection is provided, only the unique patterns at those positions are relabeled"""
+        digits = self.digits if selection is None else self.digits[selection]
+        mapped = mapping_codes[digits]
+        indexes = mapped[:, 0].copy()
+        for i in range(1, self.n):
+            indexes *= 26
+            indexes += mapped[:, i]
+        return indexes
+
+
+def _data_path(data_path):
+    """Returns the folder containing the ngram text files. Defaults to NGRAM_DATA_PATH if data_path is None"""
+    if data_path is None:
+        return NGRAM_DATA_PATH
+    return os.path.join(data_path, "")
+
+
+def _source_path(n, data_path=None):
+    """Returns the path of the ngram text file for n"""
+    return _data_path(data_path) + str(n) + "GRAM.txt"
+
+
+def _file_sha1(path):
+    """Returns the sha1 digest of a file"""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def _read_ngram_scores(n, data_path=None):
+    """Parses the ngram text file and returns (indexes, scores, score_other, avg), where indexes is an array of the
+    base 26 index of each pattern in the file and scores is an array of their scores. Scores are calculated the same
+    way as NgramData"""
+    # check if the path exists
+    path = _source_path(n, data_path)
+    if not os.path.isfile(path):
+        raise ValueError("Ngram data does not exist for n={}".format(n))
+    # read data. each line is a key followed by its count
+    with open(path, "r") as f:
+        fields = f.read().split()
+    keys = fields[0::2]
+    frequencies = [int(count_str) for count_str in fields[1::2]]
+    # check every key is n letters long
+    codes = text_to_codes("".join(keys))
+    if len(keys) != len(frequencies) or len(codes) != n * len(keys) or any(len(key) != n for key in keys):
+        raise ValueError("Invalid ngram data for n={}".format(n))
+    # now calculate the scores now that the total_count is known
+    total_count = sum(frequencies)
+    score_other = -math.log10(1 / total_count)
+    scores = [-math.log10(frequency / total_count) for frequency in frequencies]
+    sum_frequency_times_score = 0  # used to calculate the average
+    for frequency, score in zip(frequencies, scores):
+        sum_frequency_times_score += frequency * score
+    # calculate the average. The closer text is to this, the better
+    avg = sum_frequency_times_score / total_count
+    # every key is n long so every nth pattern is one of the keys
+    return ngram_indexes(codes, n)[::n], numpy.array(scores, dtype=numpy.float64), score_other, avg
+
+
+def _read_ngram_cache_header(cache_path):
+    """Returns the unpacked header of a binary cache file, or None if the file is missing or invalid"""
+    try:
+        with open(cache_path, "rb") as f:
+            header = f.read(CACHE_HEADER.size)
+    except OSError:
+        return None
+    if len(header) != CACHE_HEADER.size:
+        return None
+    header = CACHE_HEADER.unpack(header)
+    if header[1] != CACHE_VERSION:
+        return None
+    return header
+
+
+class ArrayNgramData:
+    """Base class for ngram data stored in numpy arrays, which rates text using numpy. The arrays are loaded from a
+    memory mapped binary cache, which is rebuilt when the ngram text file changes. Subclasses decide how the arrays
+    are laid out by implementing build_arrays(), cache_array_layout(), set_arrays(), lookup() and known_scores()"""
+
+    # the first 4 bytes of the cache file, and the end of the cache file name
+    CACHE_MAGIC = None
+    CACHE_SUFFIX = None
+
+    def __init__(self, n, cache_path=None, data_path=None):
+        """If cache_path is provided the arrays are attached from that cache file without checking if it is up to date.
+        data_path is the folder containing the ngram text files, which defaults to NGRAM_DATA_PATH"""
+        self.n = n
+        self.cache_path = cache_path
+        self.data_path = data_path
+
+        if self.cache_path is None:
+            # check if the path exists
+            if not os.path.isfile(_source_path(n, data_path)):
+                raise ValueError("Ngram data does not exist for n={}".format(n))
+            # use the first cache which is up to date
+            for path in self.cache_paths(n, data_path):
+                if self.cache_is_fresh(n, path, data_path):
+                    self.cache_path = path
+                    break
+        if self.cache_path is None:
+            # no cache is up to date, rebuild it
+            try:
+                self.cache_path = self.build_cache(n, data_path)
+            except OSError:
+                # nowhere is writable, use arrays in memory
+                indexes, scores, self.score_other, self.avg = _read_ngram_scores(n, data_path)
+                self.set_arrays(self.build_arrays(n, indexes, scores, self.score_other))
+                return
+
+        # read score_other and avg from the header
+        header = _read_ngram_cache_header(self.cache_path)
+        layout = self.cache_array_layout(n, self.cache_path)
+        if header is None or header[0] != self.CACHE_MAGIC or header[2] != n or layout is None:
+            raise ValueError("Invalid ngram cache {}".format(self.cache_path))
+        self.score_other, self.avg = header[-2:]
+        # memory map the arrays read only. the pages are only read from disk as they are
+        # used, and are shared between every process which maps the same file
+        arrays = []
+        offset = CACHE_HEADER.size
+        for dtype, length in layout:
+            arrays.append(numpy.memmap(self.cache_path, dtype=dtype, mode="r", offset=offset, shape=(length,)))
+            offset += numpy.dtype(dtype).itemsize * length
+        self.set_arrays(arrays)
+
+    @classmethod
+    def cache_paths(cls, n, data_path=None):
+        """Returns the paths the binary ngram cache file for n can be stored at, in order of preference"""
+        filename = str(n) + cls.CACHE_SUFFIX
+        data_path = _data_path(data_path)
+        # each data folder has its own folder inside the fallback folder
+        fallback_folder = hashlib.sha1(os.path.realpath(data_path).encode("utf-8")).hexdigest()[:16]
+        return [data_path + filename, NGRAM_CACHE_FALLBACK_PATH + fallback_folder + "/" + filename]
+
+    @classmethod
+    def cache_is_fresh(cls, n, cache_path, data_path=None):
+        """Returns if the binary cache file exists and was built from the current ngram text file"""
+        header = _read_ngram_cache_header(cache_path)
+        if header is None or cls.cache_array_layout(n, cache_path) is None:
+            return False
+        magic, version, cache_n, source_size, source_mtime, source_sha1, score_other, avg = header
+        source_path = _source_path(n, data_path)
+        source_stat = os.stat(source_path)
+        # check the cache was built from the current text file. if the modification time has changed
+        # (e.g. the file was copied) fall back to comparing the contents
+        if magic != cls.CACHE_MAGIC or cache_n != n or source_size != source_stat.st_size:
+            return False
+        return source_mtime == source_stat.st_mtime_ns or source_sha1 == _file_sha1(source_path)
+
+    @classmethod
+    def build_cache(cls, n, data_path=None):
+        """Builds the binary cache file for n from the ngram text file, even if it is already up to date. Returns the path of the cache file"""
+        indexes, scores, score_other, avg = _read_ngram_scores(n, data_path)
+        arrays = cls.build_arrays(n, indexes, scores, score_other)
+        source_path = _source_path(n, data_path)
+        source_stat = os.stat(source_path)
+        header = CACHE_HEADER.pack(cls.CACHE_MAGIC, CACHE_VERSION, n, source_stat.st_size, source_stat.st_mtime_ns,
+                                   _file_sha1(source_path), score_other, avg)
+        for cache_path in cls.cache_paths(n, data_path):
+            try:
+                # write to a temporary file first so other processes never see a half written cache
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+                with open(temp_path, "wb") as f:
+                    f.write(header)
+                    for array in arrays:
+                        f.write(array.tobytes())
+                os.replace(temp_path, cache_path)
+                return cache_path
+            except OSError:
+                # try the next location
+                continue
+        raise OSError("Could not write the ngram cache for n={}".format(n))
+
+    @classmethod
+    def build_arrays(cls, n, indexes, scores, score_other):
+        """Returns the list of arrays to be stored in the cache from the index and score of each pattern in the data set"""
+        raise NotImplementedError
+
+    @classmethod
+    def cache_array_layout(cls, n, cache_path):
+        """Returns a list of (dtype, length) of the arrays stored in a cache file, or None if the file is the wrong size"""
+        raise NotImplementedError
+
+    def set_arrays(self, arrays):
+        """Store the arrays loaded from the cache"""
+        raise NotImplementedError
+
+    def lookup(self, indexes):
+        """Returns an array of the scores of an array of pattern indexes"""
+        raise NotImplementedError
+
+    def memory_size(self):
+        """Returns the number of bytes used to store the arrays"""
+        raise NotImplementedError
+
+    def known_scores(self):
+        """Returns an array of the scores of the patterns in the data set"""
+        raise NotImplementedError
+
+    def get_score(self, key):
+        """Get the score for a specific key"""
+        # check the specified key is length n
+        if len(key) != self.n:
+            raise ValueError("len(key) != n. {} != {}".format(len(key), self.n))
+        # look up the score using the index of the key. keys containing non letters score score_other
+        codes = text_to_codes(key)
+        if len(codes) != self.n:
+            return self.score_other
+        return float(self.lookup(ngram_indexes(codes, self.n))[0])
+
+    def rate(self, text):
+        """Rate how close to English text some text is. Score of 0 is closest to English text."""
+        # convert the text into letter codes once
+        codes = text_to_codes(text)
+        # check it is at least n long
+        if len(codes) < self.n:
+            return 0
+        return self.rate_codes(codes)
+
+    def rate_codes(self, codes):
+        """Rate an array of letter codes which is at least n long. Returns the same score as rate()"""
+        # look up the score of every pattern at once
+        pattern_scores = self.lookup(ngram_indexes(codes, self.n))
+        # cumsum adds the scores in order, so the total is exactly the same as adding them one at a time
+        total_score = float(numpy.cumsum(pattern_scores)[-1])
+        # calculate the average score
+        average_score = total_score / len(pattern_scores)
+        # return how close the average_score of the text is to the average score of the dataset.
+        return abs(self.avg - average_score)
+
+    @property
+    def std(self):
+        """The standard deviation of the score of a pattern in English text. Used to estimate how reliable the
+        average score of part of a text is"""
+        if not hasattr(self, "_std"):
+            # the probability of each pattern is 10^-score as the scores are -log10(probability)
+            scores = numpy.asarray(self.known_scores())
+            probabilities = numpy.power(10, -scores)
+            probabilities /= probabilities.sum()
+            self._std = math.sqrt(float(numpy.dot(probabilities, (scores - self.avg) ** 2)))
+        return self._std
+
+    @property
+    def min_score(self):
+        """The lowest score of a pattern. Used to bound the score of the rest of a text"""
+        if not hasattr(self, "_min_score"):
+            scores = self.known_scores()
+            self._min_score = float(numpy.min(scores)) if len(scores) > 0 else self.score_other
+        return self._min_score
+
+    def rate_bounded(self, text, threshold, estimate=False):
+        """Rate text like rate(), but give up as soon as the text can't score better (lower) than threshold.
+        Returns (score, aborted). If aborted is True, score is the estimate from the part of the text which was rated.
+        By default the text is only given up on once no letters in the rest of it could bring the score under threshold,
+        so a text which would beat threshold is never given up on. If estimate is True, the text is also given up on once
+        the score of the part rated is RATE_BOUNDED_CONFIDENCE standard errors past threshold. This gives up on most texts
+        much sooner, but is a statistical estimate, so a text whose start is unusual can be given up on wrongly"""
+        # convert the text into letter codes once
+        codes = text_to_codes(text)
+        # check it is at least n long
+        if len(codes) < self.n:
+            return 0, False
+        return self.rate_codes_bounded(codes, threshold, estimate)
+
+    def rate_codes_bounded(self, codes, threshold, estimate=False):
+        """Rate an array of letter codes which is at least n long, giving up if it can't score better than threshold.
+        Returns (score, aborted) like rate_bounded()"""
+        num_patterns = len(codes) - self.n + 1
+        # the lowest and highest score a single pattern can have
+        min_score = self.min_score
+        max_score = self.score_other
+        total_score = 0.0
+        rated = 0
+        chunk_size = RATE_BOUNDED_FIRST_CHUNK
+        while rated < num_patterns:
+            # rate the next chunk of patterns. the chunk overlaps the previous one by n - 1 letters
+            chunk_end = min(num_patterns, rated + chunk_size)
+            pattern_scores = self.lookup(ngram_indexes(codes[rated:chunk_end + self.n - 1], self.n))
+            # add on to the total in order, so the final total is exactly the same as rate_codes()
+            total_score = float(numpy.cumsum(numpy.concatenate(([total_score], pattern_scores)))[-1])
+            rated = chunk_end
+            chunk_size *= 2
+            if rated == num_patterns:
+                break
+            # the running estimate of the score from the patterns rated so far
+            estimated_score = abs(self.avg - total_score / rated)
+            # whatever the remaining patterns are, the final average must be between these
+            remaining = num_patterns - rated
+            lowest_average = (total_score + remaining * min_score) / num_patterns
+            highest_average = (total_score + remaining * max_score) / num_patterns
+            lowest_possible = max(0, lowest_average - self.avg, self.avg - highest_average)
+            if lowest_possible > threshold:
+                return estimated_score, True
+            # the estimate is reliable to within a few standard errors
+            if estimate and estimated_score - RATE_BOUNDED_CONFIDENCE * self.std / math.sqrt(rated) > threshold:
+                return estimated_score, True
+        # calculate the average score
+        average_score = total_score / num_patterns
+        # return how close the average_score of the text is to the average score of the dataset.
+        return abs(self.avg - average_score), False
+
+    def rate_code_rows(self, codes):
+        """Rate each row of a 2D array of letter codes, where every row is the same length and at least n long.
+        Returns a numpy array containing the same scores as rate_codes() for each row"""
+        # look up the score of every pattern in every row at once
+        pattern_scores = self.lookup(ngram_indexes(codes, self.n))
+        # cumsum adds the scores in order, so the totals are exactly the same as rate_codes()
+        total_scores = numpy.cumsum(pattern_scores, axis=1)[:, -1]
+        # calculate the average scores
+        average_scores = total_scores / pattern_scores.shape[1]
+        # return how close the average scores of the texts are to the average score of the dataset.
+        return numpy.abs(self.avg - average_scores)
+
+    def rate_many(self, texts):
+        """Rate many texts at once. Returns a list containing the same scores as rate() for each text"""
+        scores = [0] * len(texts)
+        # group the texts by their length, so each group can be rated as one 2D array
+        groups = {}
+        for i, text in enumerate(texts):
+            codes = text_to_codes(text)
+            # texts shorter than n score 0
+            if len(codes) >= self.n:
+                groups.setdefault(len(codes), []).append((i, codes))
+        for length, group in groups.items():
+            # limit how many texts are rated at once so long texts don't use too much memory
+            rows_per_batch = max(1, RATE_MANY_BATCH_SIZE // length)
+            for start in range(0, len(group), rows_per_batch):
+                batch = group[start:start + rows_per_batch]
+                batch_scores = self.rate_code_rows(numpy.array([codes for i, codes in batch]))
+                for (i, codes), score in zip(batch, batch_scores.tolist()):
+                    scores[i] = score
+        return scores
+
+    def rate_from_counts(self, counts, mapping):
+        """Rate a text from its NgramCounts (or a dictionary of pattern:count) after relabeling it with mapping.
+        Returns the same score as rate(substitution(text, mapping)) up to floating point rounding, as the pattern scores
+        are added up in a different order, but only has to go over the unique patterns"""
+        if isinstance(counts, dict):
+            counts = NgramCounts.from_dict(counts)
+        if counts.n != self.n:
+            raise ValueError("counts.n != n. {} != {}".format(counts.n, self.n))
+        # check the text was at least n long
+        if counts.total == 0:
+            return 0
+        # look up the score of each unique pattern and weight it by how often it occurs
+        pattern_scores = self.lookup(counts.mapped_indexes(mapping_to_codes(mapping)))
+        total_score = float(numpy.dot(pattern_scores, counts.counts))
+        # calculate the average score
+        average_score = total_score / counts.total
+        # return how close the average_score of the text is to the average score of the dataset.
+        return abs(self.avg - average_score)
+
+
+class DenseNgramData(ArrayNgramData):
+    """Stores the scores in a 26^n array indexed by the base 26 index of the pattern. Used when 26^n is small enough"""
+
+    CACHE_MAGIC = b"NGRM"
+    CACHE_SUFFIX = "GRAM.bin"
+
+    @classmethod
+    def build_arrays(cls, n, indexes, scores, score_other):
+        """Returns the list of arrays to be stored in the cache from the index and score of each pattern in the data set"""
+        # every pattern not in the data set scores score_other
+        table = numpy.full(26 ** n, score_other, dtype=numpy.float64)
+        table[indexes] = scores
+        return [table]
+
+    @classmethod
+    def cache_array_layout(cls, n, cache_path):
+        """Returns a list of (dtype, length) of the arrays stored in a cache file, or None if the file is the wrong size"""
+        if os.path.getsize(cache_path) != CACHE_HEADER.size + 8 * 26 ** n:
+            return None
+        return [(numpy.float64, 26 ** n)]
+
+    def set_arrays(self, arrays):
+        """Store the arrays loaded from the cache"""
+        self.table, = arrays
+
+    def lookup(self, indexes):
+        """Returns an array of the scores of an array of pattern indexes"""
+        return self.table[indexes]
+
+    def memory_size(self):
+        """Returns the number of bytes used to store the arrays"""
+        return self.table.nbytes
+
+    def known_scores(self):
+        """Returns an array of the scores of the patterns in the data set. The table can't tell patterns which occurred
+        once apart from patterns which aren't in the data set, as both score score_other, so neither are included"""
+        return self.table[self.table != self.score_other]
+
+
+class SparseNgramData(ArrayNgramData):
+    """Stores the index of every pattern in the data set as a sorted array, with an array of their scores in the same
+    order. Scores are looked up with a binary search. Used for larger n, where a 26^n array would be too big"""
+
+    CACHE_MAGIC = b"NGRS"
+    CACHE_SUFFIX = "GRAM.sparse.bin"
+
+    @classmethod
+    def build_arrays(cls, n, indexes, scores, score_other):
+        """Returns the list of arrays to be stored in the cache from the index and score of each pattern in the data set"""
+        order = numpy.argsort(indexes, kind="mergesort")
+        return [indexes[order].astype(numpy.int64), scores[order]]
+
+    @classmethod
+    def cache_array_layout(cls, n, cache_path):
+        """Returns a list of (dtype, length) of the arrays stored in a cache file, or None if the file is the wrong size"""
+        # the file contains an 8 byte index and 8 byte score for each pattern
+        data_size = os.path.getsize(cache_path) - CACHE_HEADER.size
+        if data_size <= 0 or data_size % 16 != 0:
+            return None
+        return [(numpy.int64, data_size // 16), (numpy.float64, data_size // 16)]
+
+    def set_arrays(self, arrays):
+        """Store the arrays loaded from the cache"""
+        self.keys, self.scores = arrays
+
+    def lookup(self, indexes):
+        """Returns an array of the scores of an array of pattern indexes"""
+        # find where each index would be in the sorted keys
+        positions = numpy.searchsorted(self.keys, indexes)
+        numpy.minimum(positions, len(self.keys) - 1, out=positions)
+        # patterns which are not in the data set score score_other
+        return numpy.where(self.keys[positions] == indexes, self.scores[positions], self.score_other)
+
+    def memory_size(self):
+        """Returns the number of bytes used to store the arrays"""
+        return self.keys.nbytes + self.scores.nbytes
+
+    def known_scores(self):
+        """Returns an array of the scores of the patterns in the data set"""
+        return self.scores
+
+
+def ngram_data_class(n):
+    """Returns the ArrayNgramData subclass used for ngram data of length n"""
+    check_n(n)
+    if 26 ** n <= MAX_DENSE_TABLE_SIZE:
+        return DenseNgramData
+    return SparseNgramData
+
+
+def build_ngram_cache(n, data_path=None):
+    """Builds the binary cache file for n from the ngram text file, even if it is already up to date. Returns the path of the cache file"""
+    return ngram_data_class(n).build_cache(n, data_path)
+
+
+class SubstitutionScorer:
+    """Keeps track of the score of a text as pairs of letters in a substitution mapping are swapped. Remembers which
+    unique patterns each cipher letter occurs in, so scoring a swap only has to re-score the patterns containing the two
+    letters instead of the whole text"""
+
+    def __init__(self, ngram_data, counts, mapping):
+        self.ngram_data = ngram_data
+        self.counts = counts
+        # which unique patterns each cipher letter occurs in, as both a mask and the positions of the patterns
+        self.letter_masks = [(counts.digits == letter).any(axis=1) for letter in range(26)]
+        self.letter_patterns = [numpy.flatnonzero(mask) for mask in self.letter_masks]
+        self.set_mapping(mapping)
+
+    def set_mapping(self, mapping):
+        """Replace the mapping, re-scoring every unique pattern"""
+        self.mapping = mapping_to_codes(mapping).copy()
+        # the score of each unique pattern using the current mapping
+        self.pattern_scores = self.ngram_data.lookup(self.counts.mapped_indexes(self.mapping))
+        self.total_score = float(numpy.dot(self.pattern_scores, self.counts.counts))
+
+    def _score_total(self, total_score):
+        """Convert a total pattern score into the same score as NgramData.rate(), up to floating point rounding"""
+        if self.counts.total == 0:
+            return 0
+        return abs(self.ngram_data.avg - total_score / self.counts.total)
+
+    @property
+    def score(self):
+        """The score of the text using the current mapping"""
+        return self._score_total(self.total_score)
+
+    def _swapped(self, letter1, letter2):
+        """Returns (affected patterns, their new scores) if the mappings of the cipher letter codes were swapped"""
+        # the patterns containing letter1, then the patterns containing letter2 but not letter1
+        patterns2 = self.letter_patterns[letter2]
+        affected = numpy.concatenate((self.letter_patterns[letter1], patterns2[~self.letter_masks[letter1][patterns2]]))
+        mapping = self.mapping.copy()
+        mapping[letter1], mapping[letter2] = mapping[letter2], mapping[letter1]
+        return affected, self.ngram_data.lookup(self.counts.mapped_indexes(mapping, affected))
+
+    def swap_delta(self, letter1, letter2):
+        """Returns the change in the total pattern score if the mappings of the cipher letter codes were swapped"""
+        if letter1 == letter2:
+            return 0
+        affected, new_scores = self._swapped(letter1, letter2)
+        return float(numpy.dot(new_scores - self.pattern_scores[affected], self.counts.counts[affected]))
+
+    def score_after_swap(self, letter1, letter2):
+        """Returns the score if the mappings of the cipher letter codes were swapped, without changing the mapping"""
+        return self._score_total(self.total_score + self.swap_delta(letter1, letter2))
+
+    def apply_swap(self, letter1, letter2):
+        """Swap the mappings of the cipher letter codes, updating only the affected patterns"""
+        if letter1 == letter2:
+            return
+        affected, new_scores = self._swapped(letter1, letter2)
+        self.total_score += float(numpy.dot(new_scores - self.pattern_scores[affected], self.counts.counts[affected]))
+        self.pattern_scores[affected] = new_scores
+        self.mapping[letter1], self.mapping[letter2] = self.mapping[letter2], self.mapping[letter1]
+
+
+class NgramStream:
+    """Rates text which is provided in chunks, without needing the whole text in memory. The last n - 1 letters of each
+    chunk are carried over so patterns spanning two chunks are rated. The score so far can be read after every chunk"""
+
+    def __init__(self, ngram_data):
+        self.ngram_data = ngram_data
+        # the letter codes at the end of the previous chunk which haven't started a full pattern yet
+        self.carry = numpy.empty(0, dtype=numpy.intp)
+        self.total_score = 0.0
+        self.num_patterns = 0
+
+    def feed(self, chunk):
+        """Rate the next chunk of text. Returns the score of all the text so far"""
+        n = self.ngram_data.n
+        codes = numpy.concatenate((self.carry, text_to_codes(chunk)))
+        if len(codes) >= n:
+            pattern_scores = self.ngram_data.lookup(ngram_indexes(codes, n))
+            # add on to the total in order, so the final total is exactly the same as rating the whole text
+            self.total_score = float(numpy.cumsum(numpy.concatenate(([self.total_score], pattern_scores)))[-1])
+            self.num_patterns += len(pattern_scores)
+            # keep the letters which haven't started a full pattern yet
+            codes = codes[len(codes) - n + 1:]
+        self.carry = codes
+        return self.score
+
+    @property
+    def score(self):
+        """The score of all the text so far. The same as NgramData.rate() on all the chunks joined together"""
+        # check at least one pattern has been rated
+        if self.num_patterns == 0:
+            return 0
+        # return how close the average score of the text is to the average score of the dataset.
+        return abs(self.ngram_data.avg - self.total_score / self.num_patterns)
+
+
+class InterpolatedNgramData:
+    """Rates text using a weighted combination of the scores of several pattern lengths. The letters are indexed once
+    for the longest pattern length, and the indexes of the shorter patterns are the leading digits of those indexes"""
+
+    def __init__(self, ngram_datas, weights=None):
+        # {n: weight}
+        self.weights = dict(INTERPOLATION_WEIGHTS if weights is None else weights)
+        # {n: ngram data}
+        self.ngram_datas = ngram_datas
+        self.max_n = max(self.weights)
+
+    def rate(self, text):
+        """Rate how close to English text some text is. Score of 0 is closest to English text.
+        Pattern lengths longer than the text are left out"""
+        return self.rate_codes(text_to_codes(text))
+
+    def rate_codes(self, codes):
+        """Rate an array of letter codes. Returns the same score as rate()"""
+        # pad the codes so every letter starts a max_n long pattern, the padding is only part of the discarded patterns
+        padded = numpy.concatenate((codes, numpy.zeros(self.max_n - 1, dtype=numpy.intp)))
+        indexes = ngram_indexes(padded, self.max_n)
+        total_score = 0.0
+        total_weight = 0.0
+        for n, weight in sorted(self.weights.items()):
+            num_patterns = len(codes) - n + 1
+            if num_patterns <= 0:
+                continue
+            # the first n digits of the max_n long pattern starting at a letter are the n long pattern starting there
+            ngram_data = self.ngram_datas[n]
+            pattern_scores = ngram_data.lookup(indexes[:num_patterns] // 26 ** (self.max_n - n))
+            average_score = float(numpy.cumsum(pattern_scores)[-1]) / num_patterns
+            # how close the average score of the text is to the average score of the dataset, like rate()
+            total_score += weight * abs(ngram_data.avg - average_score)
+            total_weight += weight
+        # check at least one pattern length was rated
+        if total_weight == 0:
+            return 0
+        return total_score / total_weight
+
+    def rate_many(self, texts):
+        """Rate a list of texts. Returns a list of scores"""
+        return [self.rate(text) for text in texts]
+
+
+class NgramRegistry:
+    """Loads ngram data for several corpora (e.g. languages) as it is needed. Keeps the most recently used ngram data
+    loaded, evicting the least recently used data when the memory budget is exceeded. Pinned data is never evicted"""
+
+    def __init__(self, memory_budget=None):
+        # the maximum number of bytes of ngram data to keep loaded, or None for no limit
+        self.memory_budget = memory_budget
+        # the folder containing the ngram text files of each corpus. None means NGRAM_DATA_PATH
+        self.corpora = {DEFAULT_CORPUS: None}
+        # loaded ngram data keyed by (corpus, n, use_numpy), least recently used first
+        self.loaded = OrderedDict()
+        self.pinned = set()
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def register_corpus(self, corpus, data_path):
+        """Register the folder containing the ngram text files for a corpus"""
+        self.corpora[corpus] = data_path
+        # unload any data from a previous folder with the same name
+        for key in [key for key in self.loaded if key[0] == corpus]:
+            del self.loaded[key]
+
+    def get(self, n, corpus=DEFAULT_CORPUS, use_numpy=True):
+        """Returns the ngram data for n from the corpus, loading it if needed (see get_ngram_data)"""
+        if corpus not in self.corpora:
+            raise ValueError("Unknown corpus {}".format(corpus))
+        key = (corpus, n, use_numpy)
+        if key in self.loaded:
+            self.hits += 1
+            # mark as the most recently used
+            self.loaded.move_to_end(key)
+            return self.loaded[key]
+        self.misses += 1
+        if use_numpy:
+            ngram_data = ngram_data_class(n)(n, data_path=self.corpora[corpus])
+        else:
+            ngram_data = NgramData(n, self.corpora[corpus])
+        self.add(key, ngram_data)
+        return ngram_data
+
+    def add(self, key, ngram_data):
+        """Store already loaded ngram data, keyed by (corpus, n, use_numpy)"""
+        self.loaded[key] = ngram_data
+        self.loaded.move_to_end(key)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Unload the least recently used ngram data which isn't pinned until the memory budget is met"""
+        if self.memory_budget is None:
+            return
+        for key in list(self.loaded):
+            if self.memory_usage() <= self.memory_budget:
+                break
+            if key in self.pinned or key == keep:
+                continue
+            del self.loaded[key]
+            self.evictions += 1
+
+    def memory_usage(self):
+        """Returns the number of bytes used by the loaded ngram data"""
+        return sum(ngram_data.memory_size() for ngram_data in self.loaded.values())
+
+    def set_memory_budget(self, memory_budget):
+        """Change the memory budget, evicting ngram data if needed"""
+        self.memory_budget = memory_budget
+        self.evict()
+
+    def pin(self, n, corpus=DEFAULT_CORPUS, use_numpy=True):
+        """Load the ngram data if needed and keep it loaded until it is unpinned"""
+        self.pinned.add((corpus, n, use_numpy))
+        return self.get(n, corpus, use_numpy)
+
+    def unpin(self, n, corpus=DEFAULT_CORPUS, use_numpy=True):
+        """Allow the ngram data to be evicted again"""
+        self.pinned.discard((corpus, n, use_numpy))
+        self.evict()
+
+    def stats(self):
+        """Returns a dictionary of statistics about the registry"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "loaded": len(self.loaded), "memory_usage": self.memory_usage()}
+
+
+# the registry used by get_ngram_data, so ngram data does not have to be reloaded every time
+registry = NgramRegistry()
+
+
+def get_ngram_data(n, use_numpy=True, corpus=DEFAULT_CORPUS):
+    """Returns the instance of NgramData containing Ngrams of length n. Caches the instances so the data doesn't have to be repeatedly loaded from disk.
+    By default an ArrayNgramData instance is returned which is loaded from the binary cache and rates text using numpy
+    (a DenseNgramData for n <= 4, otherwise a SparseNgramData). If use_numpy is False the dictionary based NgramData is returned.
+    corpus is the name of a corpus registered with register_corpus()"""
+    return registry.get(n, corpus, use_numpy)
+
+
+def register_corpus(corpus, data_path):
+    """Shortcut for registry.register_corpus(corpus, data_path)"""
+    registry.register_corpus(corpus, data_path)
+
+
+def publish_ngram_data(ns=(1, 2, 3, 4), corpus=DEFAULT_CORPUS):
+    """Loads the ngram data in the parent process so it can be shared with child processes. The returned value should be
+    passed to attach_ngram_data() in each child process. The tables are memory mapped read only from the binary cache
+    files, so every process shares the same memory instead of loading its own copy. Each table is published with the
+    folder of its corpus, so a child process can reload the table from the right corpus if it is evicted"""
+    published = {}
+    for n in ns:
+        ngram_data = get_ngram_data(n, corpus=corpus)
+        # tables which could not be written to a cache file can't be shared
+        if ngram_data.cache_path is not None:
+            published[corpus, n] = (ngram_data.cache_path, registry.corpora[corpus])
+    return published
+
+
+def attach_ngram_data(published):
+    """Attaches the ngram data published by publish_ngram_data() in the parent process. Called in child processes"""
+    for (corpus, n), (cache_path, data_path) in published.items():
+        # the corpus may not be registered in the child process, or may be registered with a different folder
+        if corpus not in registry.corpora or registry.corpora[corpus] != data_path:
+            registry.register_corpus(corpus, data_path)
+        if (corpus, n, True) not in registry.loaded:
+            registry.add((corpus, n, True), ngram_data_class(n)(n, cache_path))
+
+
+def rate(text, n=4, use_numpy=True, corpus=DEFAULT_CORPUS):
+    """Shortcut for get_ngram_data(n, use_numpy, corpus).rate(text)"""
+    ngram_data = get_ngram_data(n, use_numpy, corpus)
     return ngram_data.rate(text)
+
+
+def get_interpolated_ngram_data(weights=None, corpus=DEFAULT_CORPUS):
+    """Returns an InterpolatedNgramData using the ngram data from the registry"""
+    weights = INTERPOLATION_WEIGHTS if weights is None else weights
+    return InterpolatedNgramData({n: get_ngram_data(n, corpus=corpus) for n in weights}, weights)
+
+
+def rate_interpolated(text, weights=None, corpus=DEFAULT_CORPUS):
+    """Shortcut for get_interpolated_ngram_data(weights, corpus).rate(text)"""
+    return get_interpolated_ngram_data(weights, corpus).rate(text)
+
+
+def rate_bounded(text, threshold, n=4, estimate=False):
+    """Shortcut for get_ngram_data(n).rate_bounded(text, threshold, estimate)"""
+    ngram_data = get_ngram_data(n)
+    return ngram_data.rate_bounded(text, threshold, estimate)
+
+
+def rate_stream(chunks, n=4):
+    """Rate text provided as an iterable of chunks of text, or a file object opened in text mode which is read
+    STREAM_CHUNK_SIZE characters at a time. Returns the same score as rating all the text at once"""
+    if hasattr(chunks, "read"):
+        chunks = iter(lambda read=chunks.read: read(STREAM_CHUNK_SIZE), "")
+    stream = NgramStream(get_ngram_data(n))
+    for chunk in chunks:
+        stream.feed(chunk)
+    return stream.score
+
+
+def rate_many(texts, n=4):
+    """Shortcut for get_ngram_data(n).rate_many(texts)"""
+    ngram_data = get_ngram_data(n)
+    return ngram_data.rate_many(texts)
+
+
+def ngram_counts(text, n=4):
+    """Shortcut for NgramCounts.from_text(text, n)"""
+    return NgramCounts.from_text(text, n)
+
+
+def rate_from_counts(counts, mapping, n=4):
+    """Shortcut for get_ngram_data(n).rate_from_counts(counts, mapping)"""
+    ngram_data = get_ngram_data(n)
+    return ngram_data.rate_from_counts(counts, mapping)
+
+
+if __name__ == "__main__":
+    # build step: precompile the binary cache for every ngram text file
+    for filename in sorted(os.listdir(NGRAM_DATA_PATH)):
+        if filename.endswith("GRAM.txt") and filename[:-len("GRAM.txt")].isdigit():
+            print("Built {}".format(build_ngram_cache(int(filename[:-len("GRAM.txt")]))))
@@ -19,6 +19,9 @@ class SolverWindow(tk.Frame):
         self.create_widgets()
         # start the solver
         self.solver_process = start_solver(self.solver, text)
+        # stop the solver if the application is closed, as solvers with worker processes don't run in a daemon
+        # process so would keep the application open until they finish
+        self.application.protocol("WM_DELETE_WINDOW", self.close)
         # schedule update
         self.after(1000 // 30, self.update_from_solver)
 
@@ -91,8 +94,14 @@ class SolverWindow(tk.Frame):
     def go_back(self):
         """ Method to go back to the cipher window """
         self.stop_solver()
+        self.application.protocol("WM_DELETE_WINDOW", self.application.destroy)
         self.application.show_existing(self.cipher_window)
 
+    def close(self):
+        """ Method to stop the solver and close the application """
+        self.stop_solver()
+        self.application.destroy()
+
     def stop_solver(self):
         """ Stop / wait for the solver to stop """
         if self.solver_process is not None:
@@ -1,22 +1,42 @@
 from solvers.solver_process import SolverProcess
 from ciphers.affine import *
+from utilities import mod_inverse
+import ngrams
 
 
 class AffineSolver(SolverProcess):
     """ Automatic key finder for the Affine Cipher"""
 
-    def __init__(self):
-        super(AffineSolver, self).__init__("Affine Cipher")
+    def __init__(self, config=None):
+        super(AffineSolver, self).__init__("Affine Cipher", config)
 
     def run(self, text):
         """ Run the automatic key finding """
+        self.start_run()
         # simply brute force the possibilities
         self.set_total_possibilities(26 * len(POSSIBLE_VALUES_A))
-        for a in POSSIBLE_VALUES_A:
-            for b in range(26):
-                key = (a, b)
-                plaintext = reverse_affine(text, a, b)
-                self.possibility(key, plaintext)
+        if len(text) < ngrams.INTERPOLATED_MAX_LENGTH:
+            # short texts are rated using interpolated ngrams, so rate the decrypted texts
+            for a in POSSIBLE_VALUES_A:
+                if self.should_stop():
+                    break
+                # rate every value of b together
+                keys = [(a, b) for b in range(26)]
+                self.possibilities(keys, [reverse_affine(text, a, b) for a, b in keys])
+        else:
+            # count the ngrams of the text once, then rate each key by relabeling the counts
+            counts = ngrams.ngram_counts(text)
+            keys = []
+            scores = []
+            for a in POSSIBLE_VALUES_A:
+                if self.should_stop(min(scores, default=None)):
+                    break
+                # the letter each cipher letter decrypts to for every value of b
+                a_mod_inverse = mod_inverse(a, 26)
+                keys += [(a, b) for b in range(26)]
+                scores += self.rate_mappings(counts, [[(letter - b) * a_mod_inverse % 26 for letter in range(26)] for b in range(26)])
+            # only the best keys are decrypted
+            self.best_possibilities(keys, scores, lambda key: reverse_affine(text, *key))
         self.done()
 
     def update_key_widget(self, widget, key):
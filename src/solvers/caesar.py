@@ -1,17 +1,27 @@
 from solvers.solver_process import SolverProcess
 from ciphers.caesar import *
+import ngrams
 
 
 class CaesarSolver(SolverProcess):
     """ Automatic key finder for the Caesar Cipher"""
 
-    def __init__(self):
-        super(CaesarSolver, self).__init__("Caesar Cipher")
+    def __init__(self, config=None):
+        super(CaesarSolver, self).__init__("Caesar Cipher", config)
 
     def run(self, text):
         """ Run the automatic key finding """
+        self.start_run()
         # simply brute force the 26 possibilities
         self.set_total_possibilities(26)
-        for i in range(26):
-            self.possibility(i, caesar(text, -i))
+        shifts = list(range(26))
+        if len(text) < ngrams.INTERPOLATED_MAX_LENGTH:
+            # short texts are rated using interpolated ngrams, so rate all the shifts together as texts
+            self.possibilities(shifts, [caesar(text, -i) for i in shifts])
+        else:
+            # count the ngrams of the text once, then rate each shift by relabeling the counts. only the best shifts
+            # are decrypted
+            counts = ngrams.ngram_counts(text)
+            scores = self.rate_mappings(counts, [[(letter - i) % 26 for letter in range(26)] for i in shifts])
+            self.best_possibilities(shifts, scores, lambda i: caesar(text, -i))
         self.done()
@@ -16,15 +16,15 @@ def factors(integer):
 class ScytaleSolver(SolverProcess):
     """ Automatic key finder for the Scytale Cipher"""
 
-    def __init__(self):
-        super(ScytaleSolver, self).__init__("Scytale Cipher")
+    def __init__(self, config=None):
+        super(ScytaleSolver, self).__init__("Scytale Cipher", config)
 
     def run(self, text):
         """ Run the automatic key finding """
+        self.start_run()
         # number of possibilities is the number of factors of the length
         factors_list = factors(len(text))
         self.set_total_possibilities(len(factors_list))
-        for factor in factors_list:
-            plaintext = reverse_scytale(text, factor)
-            self.possibility(factor, plaintext)
+        # rate every factor together
+        self.possibilities(factors_list, [reverse_scytale(text, factor) for factor in factors_list])
         self.done()
@@ -1,4 +1,5 @@
 import ngrams
+import random
 import time
 import multiprocessing
 import tkinter as tk
@@ -6,13 +7,21 @@ import tkinter as tk
 
 def start_solver(solver, text):
     """ Start the solver process """
-    process = multiprocessing.Process(target=run_solver, args=(solver, text), name="Solver", daemon=True)
+    # load the ngram data once in this process so the solver process can share it
+    published = ngrams.publish_ngram_data()
+    # daemon processes can't start their own processes, so solvers which use worker processes aren't daemons. the solver
+    # window terminates them when it is stopped, left or closed, otherwise closing the application would wait for them
+    process = multiprocessing.Process(target=run_solver, args=(solver, text, published), name="Solver",
+                                      daemon=not solver.uses_worker_processes)
     process.start()
     return process
 
 
-def run_solver(solver, text):
+def run_solver(solver, text, published=None):
     """ Entry point for solver process """
+    # attach the ngram data shared by the parent process
+    if published is not None:
+        ngrams.attach_ngram_data(published)
     # store the start time
     start_time = time.time()
     # actually run the solver on the text
@@ -20,13 +29,41 @@ def run_solver(solver, text):
     # log the time taken
     time_taken = time.time() - start_time
     print("Took {:.2f} seconds to solve".format(time_taken))
+    print("Rated {} possibilities, skipped {} already rated".format(solver.evaluations, solver.evaluations_saved))
+
+
+class RunConfig:
+    """ Limits and settings for a solver run. The solver stops and keeps its best outputs when any limit is reached """
+
+    def __init__(self, time_limit=None, max_evaluations=None, target_score=None, seed=None):
+        # the number of seconds the run can take, or None for no limit
+        self.time_limit = time_limit
+        # the number of possibilities the run can rate, or None for no limit
+        self.max_evaluations = max_evaluations
+        # stop as soon as an output scores less than this, or None to use the solver's default
+        self.target_score = target_score
+        # seed of the solver's random number generator, so runs with the same seed make the same choices
+        self.seed = seed
+
+    def has_limits(self):
+        """ Returns if the run is limited by time or number of evaluations """
+        return self.time_limit is not None or self.max_evaluations is not None
 
 
 class SolverProcess:
 
-    def __init__(self, cipher_name):
+    def __init__(self, cipher_name, config=None):
         self.cipher_name = cipher_name
         self.outputs = []
+        self.config = RunConfig() if config is None else config
+        # solvers can set a default target score, used if the config doesn't have one
+        self.target_score = self.config.target_score
+        # the budget used by the current run, see start_run()
+        self.start_time = None
+        self.evaluations = 0
+        # the number of evaluations skipped, as the possibility had already been rated
+        self.evaluations_saved = 0
+        self.random = random.Random(self.config.seed)
         # Queue used to send messages to the solver window
         # Each message should be a tuple of (command_name, command_args)
         # Valid commands names          Valid args
@@ -35,6 +72,40 @@ class SolverProcess:
         # increment_progress            none
         # outputs                       [(text, key, score), (text, key, score)...]
         self.solver_queue = multiprocessing.Queue()
+        # solvers which start their own worker processes set this to True, as they can't run in a daemon process
+        self.uses_worker_processes = False
+
+    def start_run(self):
+        """ Start the time and evaluation budget of a run, and reseed the random number generator. Called at the start of run() """
+        self.start_time = time.time()
+        self.evaluations = 0
+        self.evaluations_saved = 0
+        self.random = random.Random(self.config.seed)
+
+    def remaining_time(self):
+        """ Returns the number of seconds left in the run, or None if there is no time limit """
+        if self.config.time_limit is None:
+            return None
+        return max(0, self.config.time_limit - (time.time() - self.start_time))
+
+    def remaining_evaluations(self):
+        """ Returns the number of evaluations left in the run, or None if there is no limit """
+        if self.config.max_evaluations is None:
+            return None
+        return max(0, self.config.max_evaluations - self.evaluations)
+
+    def out_of_budget(self):
+        """ Returns if the run has used up its time or evaluations """
+        return self.remaining_time() == 0 or self.remaining_evaluations() == 0
+
+    def should_stop(self, best_score=None):
+        """ Returns if the run is out of budget or has found an output better than the target score. best_score is the
+        best score found so far by solvers which haven't passed it to the outputs yet """
+        if self.target_score is not None and self.outputs and self.outputs[0][2] < self.target_score:
+            return True
+        if self.target_score is not None and best_score is not None and best_score < self.target_score:
+            return True
+        return self.out_of_budget()
 
     def set_total_possibilities(self, n):
         """ Set the total number of possibilities """
@@ -44,13 +115,30 @@ class SolverProcess:
         """ Set as indeterminate """
         self.solver_queue.put(("indeterminate_possibilities", None))
 
-    def possibility(self, key, output_text):
-        """ Each new possibility should be passed to this method. """
+    def possibility(self, key, output_text, score=None):
+        """ Each new possibility should be passed to this method. The score can be provided if the solver has already calculated it """
         # increment the progress
         self.solver_queue.put(("increment_progress", None))
-        # calculate the score using 4Grams if the message is at least 4 long
-        # otherwise use ngrams where n is the length of the message
-        score = ngrams.rate(output_text, min(4, len(output_text)))
+        if score is None:
+            self.evaluations += 1
+        if score is None and len(output_text) < ngrams.INTERPOLATED_MAX_LENGTH:
+            # short messages are rated using 1 to 4 grams together, as there are too few 4grams to be reliable
+            score = ngrams.get_interpolated_ngram_data().rate(output_text)
+        elif score is None:
+            # calculate the score using 4Grams
+            ngram_data = ngrams.get_ngram_data(4)
+            if len(self.outputs) < 10:
+                score = ngram_data.rate(output_text)
+            else:
+                # stop rating the text as soon as it can't beat the worst score stored. only the hard bound is used, as
+                # the statistical estimate of rate_bounded(estimate=True) could drop a text which belongs in the outputs
+                score, aborted = ngram_data.rate_bounded(output_text, self.outputs[-1][2])
+                if aborted:
+                    return
+        self.add_output(key, output_text, score)
+
+    def add_output(self, key, output_text, score):
+        """ Add a rated possibility to the outputs if it is one of the 10 best """
         # if there are less than 10 outputs or the score is better than the
         # worst score stored, update the scores
         if len(self.outputs) < 10 or self.outputs[-1][2] > score:
@@ -61,6 +149,48 @@ class SolverProcess:
             # send it to the solver window
             self.solver_queue.put(("outputs", self.outputs[::]))
 
+    def possibilities(self, keys, output_texts):
+        """ Pass many possibilities at once, so they can be rated together instead of one at a time. """
+        # only rate as many as the budget allows
+        remaining = self.remaining_evaluations()
+        if remaining is not None:
+            keys = keys[:remaining]
+            output_texts = output_texts[:remaining]
+        self.evaluations += len(output_texts)
+        # group the texts by whether they are short enough to be rated using interpolated ngrams (see possibility)
+        groups = {}
+        for key, output_text in zip(keys, output_texts):
+            groups.setdefault(len(output_text) < ngrams.INTERPOLATED_MAX_LENGTH, []).append((key, output_text))
+        for short, group in groups.items():
+            # rate all the texts in the group in one go
+            ngram_data = ngrams.get_interpolated_ngram_data() if short else ngrams.get_ngram_data(4)
+            scores = ngram_data.rate_many([output_text for key, output_text in group])
+            for (key, output_text), score in zip(group, scores):
+                self.possibility(key, output_text, score)
+
+    def rate_mappings(self, counts, mappings):
+        """ Rate many relabelings of the same text from its NgramCounts, instead of making and rating each output text.
+        mappings are substitution mappings as 26 letter codes. Returns the scores, which are the same as rating each
+        output text up to floating point rounding. Only as many as the budget allows are rated """
+        remaining = self.remaining_evaluations()
+        if remaining is not None:
+            mappings = mappings[:remaining]
+        self.evaluations += len(mappings)
+        ngram_data = ngrams.get_ngram_data(counts.n)
+        scores = []
+        for mapping in mappings:
+            scores.append(ngram_data.rate_from_counts(counts, mapping))
+            # increment the progress
+            self.solver_queue.put(("increment_progress", None))
+        return scores
+
+    def best_possibilities(self, keys, scores, decrypt):
+        """ Add the keys with the 10 best scores to the outputs. decrypt(key) is only called to make the output text of
+        those keys """
+        best = sorted(range(len(scores)), key=lambda i: scores[i])[:10]
+        for i in best:
+            self.add_output(keys[i], decrypt(keys[i]), scores[i])
+
     def done(self):
         """ Set as done """
         self.solver_queue.put(("done", None))
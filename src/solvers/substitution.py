@@ -1,6 +1,44 @@
-from solvers.solver_process import SolverProcess
+from solvers.solver_process import SolverProcess, RunConfig
 from ciphers.substitution import *
 from ngrams import *
+from word_patterns import partial_key
+import math
+import multiprocessing
+import os
+import queue
+import time
+from collections import OrderedDict
+
+# the temperature simulated annealing starts at and cools down to. the temperature is in the same units as the score,
+# so a swap which makes the score 0.01 worse is kept with probability e^(-0.01 / temperature)
+ANNEAL_START_TEMPERATURE = 0.02
+ANNEAL_END_TEMPERATURE = 0.0002
+# the number of swaps simulated annealing tries in each run
+ANNEAL_ITERATIONS = 2000
+# the number of swaps tried between checks of the time limit
+ANNEAL_TIME_CHECK_INTERVAL = 256
+# the number of times the solver anneals a mapping before giving up
+ANNEAL_RESTARTS = 100
+# mappings which score less than this are assumed to be the answer
+ACCEPT_SCORE = 0.25
+# long texts are first climbed using COARSE_N grams, which are cheaper to rate, then refined using 4grams
+COARSE_N = 2
+STAGED_MIN_LENGTH = 5000
+COARSE_START_TEMPERATURE = 0.01
+COARSE_END_TEMPERATURE = 0.0001
+# texts whose words pin down fewer letters than this, or letters making up less than MIN_PARTIAL_KEY_COVERAGE of the
+# text, don't seed the mapping (see word_patterns.partial_key). texts of SEED_MAX_LENGTH letters or more aren't seeded
+# either, as the search finds their mapping in a restart or two and matching the words would take longer than it saves
+MIN_PARTIAL_KEY_LETTERS = 6
+MIN_PARTIAL_KEY_COVERAGE = 0.8
+SEED_MAX_LENGTH = 500
+# seeded mappings are annealed for fewer swaps starting from a lower temperature, so most of the seeded letters are kept
+SEEDED_START_TEMPERATURE = 0.002
+SEEDED_ITERATIONS = 600
+# the maximum number of mappings VisitedMappings remembers the score of. each uses roughly 200 bytes
+VISITED_MAX_SIZE = 2 ** 16
+# the number of seconds a parallel solver waits for a result before checking its workers are still running
+WORKER_POLL_INTERVAL = 0.5
 
 
 def get_starting_mapping(text):
@@ -29,6 +67,11 @@ def get_starting_mapping(text):
     return mapping
 
 
+def codes_to_mapping(codes):
+    """ Converts an array of 26 letter codes into a mapping dictionary of letter:letter """
+    return {letter: ascii_uppercase[code] for letter, code in zip(ascii_uppercase, codes)}
+
+
 def uppercase_starting_index(index):
     """Returns the alphabet starting at index and then looping back around"""
     # index 0:      A, B, ..., Y, Z
@@ -36,75 +79,327 @@ def uppercase_starting_index(index):
     return ascii_uppercase[index:] + ascii_uppercase[:index]
 
 
+class VisitedMappings:
+    """ Remembers the scores of recently rated mappings, so mappings the search comes back to aren't rated again.
+    Each mapping is stored as 26 bytes, and the least recently used are forgotten once max_size are stored """
+
+    def __init__(self, max_size=VISITED_MAX_SIZE):
+        self.max_size = max_size
+        self.scores = OrderedDict()
+        # the number of ratings skipped because the mapping had already been rated
+        self.hits = 0
+
+    def score_after_swap(self, scorer, letter1, letter2):
+        """ Returns (scorer.score_after_swap(letter1, letter2), rated). rated is False if the score was remembered """
+        key = bytearray(scorer.mapping.astype(numpy.uint8))
+        key[letter1], key[letter2] = key[letter2], key[letter1]
+        key = bytes(key)
+        score = self.scores.get(key)
+        if score is not None:
+            self.hits += 1
+            # mark as the most recently used
+            self.scores.move_to_end(key)
+            return score, False
+        score = scorer.score_after_swap(letter1, letter2)
+        self.scores[key] = score
+        # forget the least recently used mapping to keep the memory use capped
+        if len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+        return score, True
+
+
+class SubstitutionAnnealer:
+    """ Improves the mapping of a SubstitutionScorer using simulated annealing. Random swaps of two letters are kept if
+    they improve the score, or with a probability which shrinks as the temperature cools down if they make it worse """
+
+    def __init__(self, scorer, start_temperature=ANNEAL_START_TEMPERATURE, end_temperature=ANNEAL_END_TEMPERATURE,
+                 iterations=ANNEAL_ITERATIONS, time_limit=None, random_generator=random, visited=None):
+        self.scorer = scorer
+        self.start_temperature = start_temperature
+        self.end_temperature = end_temperature
+        self.iterations = iterations
+        # the maximum number of seconds run() takes, or None for no limit
+        self.time_limit = time_limit
+        self.random = random_generator
+        # the VisitedMappings used to skip rating mappings which have been rated before
+        self.visited = VisitedMappings() if visited is None else visited
+        # swapping two letters which aren't in the text doesn't change the score, so only try swaps involving a letter in the text
+        letters = [letter for letter in range(26) if len(scorer.letter_patterns[letter]) > 0]
+        self.swaps = [(letter1, letter2) for letter1 in range(26) for letter2 in range(letter1 + 1, 26)
+                      if letter1 in letters or letter2 in letters]
+        # the number of swaps rated by the last run, and the number skipped as they had been rated before
+        self.evaluations = 0
+        self.evaluations_saved = 0
+
+    def temperature(self, iteration):
+        """ Returns the temperature at an iteration. Cools geometrically from start_temperature to end_temperature """
+        return self.start_temperature * (self.end_temperature / self.start_temperature) ** (iteration / self.iterations)
+
+    def run(self, max_evaluations=None):
+        """ Anneal the mapping of the scorer, stopping early if max_evaluations swaps are rated. Leaves the scorer on
+        the best mapping found and returns its score """
+        scorer = self.scorer
+        score = best_score = scorer.score
+        best_mapping = scorer.mapping.copy()
+        deadline = None if self.time_limit is None else time.time() + self.time_limit
+        self.evaluations = 0
+        self.evaluations_saved = 0
+        if not self.swaps:
+            return best_score
+        for iteration in range(self.iterations):
+            # check the time limit every so often, as checking the time is slower than rating a swap
+            if deadline is not None and iteration % ANNEAL_TIME_CHECK_INTERVAL == 0 and time.time() > deadline:
+                break
+            if self.evaluations == max_evaluations:
+                break
+            letter1, letter2 = self.swaps[self.random.randrange(len(self.swaps))]
+            new_score, rated = self.visited.score_after_swap(scorer, letter1, letter2)
+            self.evaluations += rated
+            self.evaluations_saved += not rated
+            # always keep improvements, sometimes keep worse mappings to escape local minimums
+            change = new_score - score
+            if change <= 0 or self.random.random() < math.exp(-change / self.temperature(iteration)):
+                scorer.apply_swap(letter1, letter2)
+                score = new_score
+                if score < best_score:
+                    best_score = score
+                    best_mapping = scorer.mapping.copy()
+        # go back to the best mapping, re-scoring every pattern so rounding errors from the swaps don't build up
+        scorer.set_mapping(best_mapping)
+        return scorer.score
+
+
+def substitution_worker(text, config, shuffle_first, staged, use_word_patterns, published, results, stop):
+    """ Entry point for the worker processes of a parallel SubstitutionSolver. Repeatedly improves a random mapping,
+    putting (mapping codes, score, evaluations, evaluations saved) on the results queue after each restart until stop is
+    set or the worker's share of the run's budget in config is used up """
+    # attach the ngram data shared by the solver process
+    attach_ngram_data(published)
+    parent_pid = os.getppid()
+    solver = SubstitutionSolver(config, processes=1, staged=staged, use_word_patterns=use_word_patterns)
+    solver.start_run()
+    scorer, annealer, coarse_annealer = solver.create_search(text)
+    # the first worker starts from the mapping seeded from the word patterns if there is one
+    seeded = not shuffle_first and solver.seed_from_words(scorer, text)
+    while True:
+        # the first worker starts from the letter frequency mapping, the others from random mappings
+        if shuffle_first:
+            solver.shuffle_mapping(scorer)
+        shuffle_first = True
+        evaluations = solver.evaluations
+        evaluations_saved = solver.evaluations_saved
+        score = solver.improve(scorer, annealer, coarse_annealer, seeded)
+        seeded = False
+        # stop if the solver has finished, or has been killed without stopping the workers
+        if stop.is_set() or os.getppid() != parent_pid:
+            return
+        results.put((scorer.mapping.tolist(), score, solver.evaluations - evaluations, solver.evaluations_saved - evaluations_saved))
+        if solver.out_of_budget():
+            return
+
+
 class SubstitutionSolver(SolverProcess):
     """ Automatic key finder for the Substitution Cipher"""
 
-    def __init__(self):
-        super(SubstitutionSolver, self).__init__("Substitution Cipher")
+    def __init__(self, config=None, processes=None, staged=True, use_word_patterns=True):
+        super(SubstitutionSolver, self).__init__("Substitution Cipher", config)
         self.swap_index1 = 0
         self.swap_index2 = 0
+        # the number of worker processes to run restarts in. None means one per cpu, 1 runs them in this process.
+        # seeded runs always run in this process, as the order the results of workers arrive in can vary
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        if self.config.seed is not None:
+            self.processes = 1
+        self.uses_worker_processes = self.processes > 1
+        # whether texts at least STAGED_MIN_LENGTH long are climbed using COARSE_N grams before 4grams
+        self.staged = staged
+        # whether the first mapping is seeded by matching the words of the text to common words with the same pattern
+        self.use_word_patterns = use_word_patterns
+        # mappings which score less than ACCEPT_SCORE are assumed to be the answer, unless the config sets a target
+        if self.target_score is None:
+            self.target_score = ACCEPT_SCORE
+        # the scores of the mappings rated in the current run
+        self.visited = VisitedMappings()
 
-    def try_swapping(self, text, mapping, score):
-        """ Tries to improve the mapping by swapping two letters"""
+    def try_swapping(self, scorer, score, visited):
+        """ Tries to improve the mapping by swapping two letters, skipping mappings in visited which have been rated
+        before. Returns the new score or None if no swap improves it or the budget runs out"""
         # carry on checking from the where the improvement was last time
         for letter1 in uppercase_starting_index(self.swap_index1):
             for letter2 in uppercase_starting_index(self.swap_index2):
                 # only try to swap with letters after letter1
                 if letter2 <= letter1:
                     continue
-                # copy the mapping, swapping the values
-                new_mapping = mapping.copy()
-                new_mapping[letter1], new_mapping[letter2] = new_mapping[letter2], new_mapping[letter1]
-                # rate the output using the new mapping
-                new_score = rate(substitution(text, new_mapping))
+                if self.out_of_budget():
+                    return None
+                # rate the output with the two letters swapped, only re-scoring the patterns containing them
+                code1 = ascii_uppercase.index(letter1)
+                code2 = ascii_uppercase.index(letter2)
+                new_score, rated = visited.score_after_swap(scorer, code1, code2)
+                self.evaluations += rated
+                self.evaluations_saved += not rated
                 if new_score < score:
                     # store the current index where the improvement was to continue from later
-                    self.swap_index1 = ascii_uppercase.index(letter1)
-                    self.swap_index2 = ascii_uppercase.index(letter2)
-                    # if the new mapping is better, return it
-                    return new_mapping, new_score
+                    self.swap_index1 = code1
+                    self.swap_index2 = code2
+                    # if the new mapping is better, keep it
+                    scorer.apply_swap(code1, code2)
+                    return new_score
             # reset the swap index so the next inner loop starts at 0
             self.swap_index2 = 0
         # reset the swap index so the time the function is called it starts at 0
         self.swap_index1 = 0
         # no better mapping found by swapping
-        return None, None
+        return None
+
+    def create_search(self, text):
+        """ Returns (scorer, annealer, coarse annealer) for the text. The coarse annealer is None unless the search is
+        staged, as short texts don't have enough COARSE_N grams to show which way to climb """
+        counts = ngram_counts(text, 4)
+        scorer = SubstitutionScorer(get_ngram_data(4), counts, get_starting_mapping(text))
+        annealer = SubstitutionAnnealer(scorer, random_generator=self.random, visited=self.visited)
+        coarse_annealer = None
+        if self.staged and counts.total >= STAGED_MIN_LENGTH:
+            coarse_scorer = SubstitutionScorer(get_ngram_data(COARSE_N), ngram_counts(text, COARSE_N), scorer.mapping)
+            coarse_annealer = SubstitutionAnnealer(coarse_scorer, COARSE_START_TEMPERATURE, COARSE_END_TEMPERATURE,
+                                                   random_generator=self.random)
+        return scorer, annealer, coarse_annealer
+
+    def climb(self, scorer, annealer):
+        """ Anneals the mapping of the scorer, then swaps letters until no swap improves it. Returns the score """
+        # keep the annealing within the budget of the run
+        annealer.time_limit = self.remaining_time()
+        score = annealer.run(self.remaining_evaluations())
+        self.evaluations += annealer.evaluations
+        self.evaluations_saved += annealer.evaluations_saved
+        return self.polish(scorer, score, annealer.visited)
+
+    def polish(self, scorer, score, visited):
+        """ Swaps letters until no swap improves the mapping of the scorer. Returns the score """
+        new_score = score
+        while new_score is not None:
+            score = new_score
+            new_score = self.try_swapping(scorer, score, visited)
+        return score
+
+    def improve(self, scorer, annealer, coarse_annealer=None, seeded=False):
+        """ Improves the mapping of the scorer. If there is a coarse annealer, the mapping is climbed using its cheaper
+        scorer first, then refined by swapping letters using the scorer. If seeded, the mapping is already close to
+        the answer, so it is annealed from a lower temperature to fix the letters the seed got wrong without losing the rest """
+        if seeded:
+            seeded_annealer = SubstitutionAnnealer(scorer, SEEDED_START_TEMPERATURE, iterations=SEEDED_ITERATIONS,
+                                                   random_generator=self.random, visited=annealer.visited)
+            return self.climb(scorer, seeded_annealer)
+        if coarse_annealer is None:
+            return self.climb(scorer, annealer)
+        coarse_annealer.scorer.set_mapping(scorer.mapping)
+        self.climb(coarse_annealer.scorer, coarse_annealer)
+        scorer.set_mapping(coarse_annealer.scorer.mapping)
+        return self.polish(scorer, scorer.score, annealer.visited)
+
+    def seed_from_words(self, scorer, text):
+        """ Sets the mapping of the scorer to the letters which the word patterns of the text pin down, keeping the
+        rest of the mapping. Returns if the mapping was seeded, which it isn't for long texts or if too little of the
+        text is pinned down """
+        if not self.use_word_patterns:
+            return False
+        codes = text_to_codes(text)
+        if len(codes) >= SEED_MAX_LENGTH:
+            return False
+        key = partial_key(text)
+        if len(key) < MIN_PARTIAL_KEY_LETTERS or numpy.isin(codes, list(key)).mean() < MIN_PARTIAL_KEY_COVERAGE:
+            return False
+        mapping = list(scorer.mapping)
+        for code, plain in key.items():
+            # swap with the cipher letter mapped to the plain letter, so the mapping stays one to one
+            other = mapping.index(plain)
+            mapping[code], mapping[other] = mapping[other], mapping[code]
+        scorer.set_mapping(mapping)
+        return True
+
+    def shuffle_mapping(self, scorer):
+        """ Randomly shuffle the mapping of the scorer """
+        values = list(scorer.mapping)
+        self.random.shuffle(values)
+        scorer.set_mapping(values)
+
+    def restarts_left(self, repeat):
+        """ Returns if the solver should carry on restarting. Without a time or evaluation limit the solver gives up after ANNEAL_RESTARTS """
+        if self.should_stop():
+            return False
+        return self.config.has_limits() or repeat < ANNEAL_RESTARTS
 
     def run(self, text):
         """ Run the automatic key finding """
+        self.start_run()
+        self.visited = VisitedMappings()
         # total number of tries needed is unknown
         self.set_indeterminate_possibilities()
-        # get a starting mapping based off letter frequencies
-        best_mapping = get_starting_mapping(text)
-        # rate the starting mapping
-        best_score = rate(substitution(text, best_mapping))
-
-        # try up to 10000 times randomly shuffling the key, then swapping letters
-        for repeat in range(10000):
-            for i in range(5000):
-                # try swapping pairs of letters up to 5000 times to improve the mapping
-                self.possibility(best_mapping, substitution(text, best_mapping))
-                new_mapping, new_score = self.try_swapping(text, best_mapping, best_score)
-                if new_mapping is None:
-                    # if the mapping could not be improved
-                    if best_score < 0.25:
-                        # if the mapping scores less than 0.25, assume it is
-                        # the answer and stop
-                        self.done()
-                        return
-                    else:
-                        # otherwise stop trying to swap this key
-                        break
-                best_mapping = new_mapping
-                best_score = new_score
+        if self.processes > 1:
+            self.run_parallel(text)
+            return
+        # count the patterns in the text once, so mappings can be rated without translating the text
+        scorer, annealer, coarse_annealer = self.create_search(text)
+        seeded = self.seed_from_words(scorer, text)
+
+        repeat = 0
+        while self.restarts_left(repeat):
+            if repeat > 0:
+                # try again from a random mapping
+                self.shuffle_mapping(scorer)
+            best_score = self.improve(scorer, annealer, coarse_annealer, seeded and repeat == 0)
+            best_mapping = codes_to_mapping(scorer.mapping)
+            self.possibility(best_mapping, substitution(text, best_mapping), best_score)
+            repeat += 1
+
+        self.done()
 
-            # as the key cannot be improved by swapping, try randomly shuffling
-            values = list(best_mapping.values())
-            random.shuffle(values)
-            best_mapping = {key: value for key, value in zip(best_mapping.keys(), values)}
-            best_score = rate(substitution(text, best_mapping))
+    def run_parallel(self, text):
+        """ Run the restarts in a pool of worker processes, each with its own seed """
+        # the workers attach to the ngram data loaded by this process instead of loading their own copy
+        published = publish_ngram_data((1, COARSE_N, 4))
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        # each worker gets the time left and an equal share of the evaluations left, so together they stay in budget
+        remaining_evaluations = self.remaining_evaluations()
+        processes = self.processes if remaining_evaluations is None else min(self.processes, remaining_evaluations)
+        workers = []
+        for i in range(processes):
+            max_evaluations = None
+            if remaining_evaluations is not None:
+                max_evaluations = remaining_evaluations // processes + (i < remaining_evaluations % processes)
+            config = RunConfig(self.remaining_time(), max_evaluations, seed=self.random.randrange(2 ** 32))
+            args = (text, config, i > 0, self.staged, self.use_word_patterns, published, results, stop)
+            workers.append(multiprocessing.Process(target=substitution_worker, args=args,
+                                                   name="Substitution worker {}".format(i), daemon=True))
+        for worker in workers:
+            worker.start()
+        try:
+            # merge the mappings found by the workers into the outputs as they arrive
+            repeat = 0
+            while self.restarts_left(repeat):
+                try:
+                    # poll so the solver notices if the workers have all stopped without sending a result
+                    remaining_time = self.remaining_time()
+                    timeout = WORKER_POLL_INTERVAL if remaining_time is None else min(WORKER_POLL_INTERVAL, remaining_time)
+                    codes, score, evaluations, evaluations_saved = results.get(timeout=timeout)
+                except queue.Empty:
+                    if self.out_of_budget() or not any(worker.is_alive() for worker in workers):
+                        # out of time, or every worker has used up its share of the budget or crashed
+                        break
+                    continue
+                self.evaluations += evaluations
+                self.evaluations_saved += evaluations_saved
+                mapping = codes_to_mapping(codes)
+                self.possibility(mapping, substitution(text, mapping), score)
+                repeat += 1
+        finally:
+            # cancel every worker, even if they are part way through a restart
+            stop.set()
+            for worker in workers:
+                worker.terminate()
+                worker.join()
 
-        # no mapping found with score less than 0.25
         self.done()
 
     def update_key_widget(self, widget, mapping):
@@ -1,105 +1,471 @@
 from solvers.solver_process import SolverProcess
 from ciphers.vigenere import *
-from ciphers.caesar import caesar
-from ngrams import get_ngram_data
+from ngrams import get_ngram_data, ngram_indexes, text_to_codes
 from string import ascii_uppercase
 from utilities import letters_only_uppercase
-import itertools
-
-
-# cache the two gram data locally
-bigram_data = get_ngram_data(2)
-bigram_scores = {}
-for letter1 in ascii_uppercase:
-    for letter2 in ascii_uppercase:
-        # store the key as a tuple to avoid having to concatenate the two letters repeatedly in the solver
-        bigram_scores[letter1, letter2] = bigram_data.get_score(letter1 + letter2)
-
-
-def best_n_long_key(cipher_text, reverse_caesars, key_len):
-    """ Finds the best key for the ciphertext which is `key_len` long """
-
-    # array to store the best two keys for each position
-    key_possibilities = [[] for _ in range(key_len)]
-    # for each position in the key
-    for key_index in range(key_len):
-        # store the best average score and keys
-        best_average = float("inf")
-        best_key1 = "A"
-        best_key2 = "A"
-        for key1, key2 in itertools.product(ascii_uppercase, repeat=2):
-            # try every possible pair of keys
-            total_score = 0
-            count = 0
-            # get the corresponding reverse caesar string for two keys
-            string_a = reverse_caesars[key1]
-            string_b = reverse_caesars[key2]
-            for text_idx in range(key_index, len(cipher_text) - 1, key_len):
-                # for every position which this key index would apply to the
-                # ciphertext, decrypt the letters and rate the result
-                letter_a = string_a[text_idx]  # use the pre-calculated reverse caesars
-                letter_b = string_b[text_idx + 1]
-                # used the cached local ngram data, avoid having to concatenate the letters
-                total_score += bigram_scores[letter_a, letter_b]
-                count += 1
-            # work out the average score using the key1 key2 pair
-            average = total_score / count
-            if average < best_average:
-                # if it is better than the previous, store it
-                best_average = average
-                best_key1 = key1
-                best_key2 = key2
-        # after trying every possible pair of keys store the best key
-        # letter 1 & 2 in the relevant positions
-        key_possibilities[key_index].append((best_key1, best_average))
-        # if this is the last key index the second letter is actually the
-        # first key index as the key is repeated
-        key_index2 = (key_index + 1) % key_len
-        key_possibilities[key_index2].append((best_key2, best_average))
-    # make a key from the best letter from each position
-    key = ""
-    for letter_possibilities in key_possibilities:
-        # sort the possibility by the average score
-        letter_possibilities.sort(key=lambda x: x[1])
-        # add the letter from the possibility with the lowest score to the key
-        key += letter_possibilities[0][0]
+import multiprocessing
+import numpy
+
+
+# cache the one and two gram data locally as tables, unigram_table[letter] and bigram_table[letter1, letter2] = score
+unigram_table = get_ngram_data(1).table
+bigram_table = get_ngram_data(2).table.reshape(26, 26)
+# key pairs whose totals are within this fraction of the best total are treated as equally good, so the first of them
+# is used however the sums were rounded
+TIE_TOLERANCE = 1e-10
+# the index of coincidence of english and of random letters: the chance that two letters picked from the text are the same
+ENGLISH_COINCIDENCE = float(((10.0 ** -unigram_table) ** 2).sum())
+RANDOM_COINCIDENCE = 1 / 26
+# the length of the repeated patterns whose distances apart are used for the Kasiski examination
+KASISKI_N = 3
+# keys shorter than this are found from the bigrams of each column. longer keys are only tried if the text has at least
+# LONG_KEY_MIN_COLUMN_LENGTH letters for each letter of the key
+MAX_SHORT_KEY_LENGTH = 50
+LONG_KEY_MIN_COLUMN_LENGTH = 5
+# long key lengths are scored by the average coincidence rate at up to this many multiples of the length
+PERIOD_MULTIPLES = 20
+# long key lengths scoring at least this fraction of the way from random to the best score are tried, shortest first,
+# leaving out multiples of the lengths already chosen
+LONG_KEY_THRESHOLD = 0.75
+LONG_KEY_CANDIDATES = 3
+# a key found at two lengths is only taken as the answer if the index of coincidence of its columns is at least this
+# fraction of the way from random to english. the columns of a length which is a factor of the real length are only
+# partly english, e.g. about half way for half the real length
+REPEATED_KEY_MIN_ENGLISH = 0.75
+# refine_key() stops after changing the letters of the key this many times over
+REFINE_PASSES = 10
+# keys are only refined if each letter decrypts at least this many letters. with fewer, a long wrong key can be changed
+# into one which decrypts to likely looking nonsense
+REFINE_MIN_COLUMN_LENGTH = 5
+# keys are only refined if the index of coincidence of the columns is at least this fraction of the way from random to
+# english. the wrong length can't be refined into the right key, so there's no point trying
+REFINE_MIN_ENGLISH = 0.3
+# keys are refined using at most this many letters from the start of the text, which is plenty to tell the letters of
+# keys up to 50 long apart
+REFINE_MAX_LENGTH = 5000
+# the number of patterns VigenereScorer.group_totals() scores for all 26 shifts at once
+REFINE_BLOCK_SIZE = 2 ** 14
+# the analysis of the ciphertext in each worker process of a parallel VigenereSolver
+_worker_analysis = None
+
+
+def kasiski_distances(codes, n=KASISKI_N):
+    """Returns an array of the distances between each `n` long pattern and the next time it is repeated in the text"""
+    if len(codes) < n:
+        return numpy.empty(0, dtype=numpy.intp)
+    indexes = ngram_indexes(codes, n)
+    # sort by pattern, keeping the positions of the same pattern in order
+    order = numpy.argsort(indexes, kind="mergesort")
+    repeated = indexes[order][1:] == indexes[order][:-1]
+    return (order[1:] - order[:-1])[repeated]
+
+
+def decrypt(text, shifts):
+    """The same as reverse_vigenere(text, shifts), but decrypts every letter at once using numpy so long texts and keys
+    are fast"""
+    # the character codes of the text, four bytes each so non ascii characters are kept
+    chr_codes = numpy.frombuffer(text.encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.int64)
+    upper = (65 <= chr_codes) & (chr_codes <= 90)
+    letters = upper | ((97 <= chr_codes) & (chr_codes <= 122))
+    offsets = numpy.where(upper[letters], 65, 97)
+    # the key only moves on after each letter
+    letter_shifts = numpy.array(shifts, dtype=numpy.int64)[numpy.arange(len(offsets)) % len(shifts)]
+    chr_codes[letters] = offsets + (chr_codes[letters] - offsets - letter_shifts) % 26
+    return chr_codes.astype(numpy.uint32).tobytes().decode("utf-32-le")
+
+
+def shortest_repeat(key):
+    """Returns the shortest key which repeated gives the key, e.g. KEYKEY -> KEY. Both keys decrypt the same way"""
+    for length in range(1, len(key)):
+        if len(key) % length == 0 and key[:length] * (len(key) // length) == key:
+            return key[:length]
     return key
 
 
+def shifted_bigram_table(table):
+    """Returns a 676x676 array where array[key1 * 26 + key2, a * 26 + b] is the score of the cipher letters a, b
+    decrypted with the key letters key1, key2"""
+    # shifts[key, letter] = the letter decrypted with the key
+    shifts = (numpy.arange(26)[None, :] - numpy.arange(26)[:, None]) % 26
+    return table[shifts[:, None, :, None], shifts[None, :, None, :]].reshape(676, 676)
+
+
+class VigenereAnalysis:
+    """Statistics of a Vigenère ciphertext for every key length. The letters and pairs of letters in each column of
+    the text written in rows `period` long are counted in one pass over the text and cached, and the counts of a period
+    are added up from the counts of a multiple of it if they have already been counted. Keys are found from the counts,
+    so after counting a period the time taken doesn't depend on the length of the text.
+    Each period which isn't added up from a multiple still takes its own pass. rank_key_lengths() counts the letters of
+    every length longest first, but lengths over half of MAX_SHORT_KEY_LENGTH have no multiple to add up from, so that
+    is still about 25 passes. The pairs are only counted for the lengths best_key() is asked for, in the order they are
+    tried, so they are rarely added up from a multiple: a run which stops after two lengths counts two, while one which
+    tries every length counts most of them separately"""
+
+    def __init__(self, codes, table=None):
+        # the ciphertext letter codes, one byte each
+        self.codes = numpy.asarray(codes, dtype=numpy.uint8)
+        self.table = bigram_table if table is None else table
+        self.pair_scores = shifted_bigram_table(self.table)
+        # {period: array[offset, letter]} and {period: array[offset, letter1 * 26 + letter2]}. each pair is counted
+        # in the column of its first letter
+        self.letter_counts_cache = {}
+        self.pair_counts_cache = {}
+        # array[distance] of how many letters are the same as the letter `distance` after them
+        self.coincidence_counts = None
+
+    def cached_counts(self, cache, period, count):
+        """Returns the counts of a period from the cache, adding up the counts of a multiple of the period or counting
+        them with count(period) if they aren't cached"""
+        if period not in cache:
+            multiples = [multiple for multiple in cache if multiple % period == 0]
+            if multiples:
+                # the offsets offset, offset + period, offset + 2 * period, ... of the multiple are the same column
+                multiple = min(multiples)
+                cache[period] = cache[multiple].reshape(multiple // period, period, -1).sum(axis=0)
+            else:
+                cache[period] = count(period)
+        return cache[period]
+
+    def count_letters(self, period):
+        """Returns an array[offset, letter] of how often each letter is in each column"""
+        columns = numpy.arange(len(self.codes)) % period
+        return numpy.bincount(columns * 26 + self.codes, minlength=26 * period).reshape(period, 26)
+
+    def count_pairs(self, period):
+        """Returns an array[offset, letter1 * 26 + letter2] of how often each pair of letters starts in each column"""
+        codes = self.codes.astype(numpy.intp)
+        columns = numpy.arange(len(codes) - 1) % period
+        pairs = codes[:-1] * 26 + codes[1:]
+        return numpy.bincount(columns * 676 + pairs, minlength=676 * period).reshape(period, 676)
+
+    def letter_counts(self, period):
+        """Returns an array[offset, letter] of how often each letter is in each column"""
+        return self.cached_counts(self.letter_counts_cache, period, self.count_letters)
+
+    def pair_counts(self, period):
+        """Returns an array[offset, letter1 * 26 + letter2] of how often each pair of letters starts in each column.
+        Usually a pass over the text, as the lengths are tried most likely first rather than longest first"""
+        return self.cached_counts(self.pair_counts_cache, period, self.count_pairs)
+
+    def coincidence(self, period):
+        """Returns the index of coincidence of the letters in each column of the text written in rows `period` long,
+        counting the pairs of letters in all the columns together"""
+        counts = self.letter_counts(period)
+        column_lengths = counts.sum(axis=1)
+        pairs = (column_lengths * (column_lengths - 1)).sum()
+        if pairs == 0:
+            return RANDOM_COINCIDENCE
+        return (counts * (counts - 1)).sum() / pairs
+
+    def english_fraction(self, key_len):
+        """Returns how far the index of coincidence of the columns is from random letters (0) to english (1)"""
+        return (self.coincidence(key_len) - RANDOM_COINCIDENCE) / (ENGLISH_COINCIDENCE - RANDOM_COINCIDENCE)
+
+    def rank_key_lengths(self, lengths):
+        """Returns the key lengths sorted by how likely they are, most likely first. Each length is scored by how close
+        the index of coincidence of its columns is to english, plus how much more often than by chance the distances
+        between repeated patterns are a multiple of it"""
+        distances = kasiski_distances(self.codes.astype(numpy.intp))
+        scores = {}
+        # the longest first, so the counts of shorter lengths can be added up from the counts of their multiples
+        for key_len in sorted(lengths, reverse=True):
+            # columns of only a few letters can be more english than english by chance, which doesn't make the length
+            # any more likely than one which is exactly english
+            score = min(self.english_fraction(key_len), 1)
+            if len(distances) > 0:
+                score += numpy.mean(distances % key_len == 0) - 1 / key_len
+            scores[key_len] = score
+        # stable sort so equally likely lengths are tried shortest first
+        return sorted(lengths, key=lambda key_len: (-scores[key_len], key_len))
+
+    def coincidences(self):
+        """Returns an array[distance] of how many letters are the same as the letter `distance` after them. Found for
+        every distance at once by adding up the autocorrelation of where each letter is, using FFTs"""
+        if self.coincidence_counts is None:
+            # pad to at least twice the length so the correlation doesn't wrap around
+            size = 2 ** int(2 * len(self.codes) - 1).bit_length()
+            power = numpy.zeros(size // 2 + 1)
+            for letter in range(26):
+                transform = numpy.fft.rfft(self.codes == letter, size)
+                power += transform.real ** 2 + transform.imag ** 2
+            self.coincidence_counts = numpy.rint(numpy.fft.irfft(power, size)[:len(self.codes)]).astype(numpy.int64)
+        return self.coincidence_counts
+
+    def period_scores(self, max_len):
+        """Returns an array[key length] of the average rate of coincidences at the first PERIOD_MULTIPLES multiples of
+        each key length up to max_len. Letters a multiple of the key length apart are shifted by the same key letter,
+        so they are the same as often as in english"""
+        distances = numpy.arange(1, len(self.codes))
+        rates = numpy.zeros(len(self.codes))
+        rates[1:] = self.coincidences()[1:] / (len(self.codes) - distances)
+        totals = numpy.zeros(max_len + 1)
+        counts = numpy.zeros(max_len + 1)
+        key_lens = numpy.arange(max_len + 1)
+        for multiple in range(1, PERIOD_MULTIPLES + 1):
+            # the key lengths which have this multiple at most max_len
+            in_range = key_lens[1:max_len // multiple + 1]
+            totals[in_range] += rates[in_range * multiple]
+            counts[in_range] += 1
+        scores = numpy.full(max_len + 1, RANDOM_COINCIDENCE)
+        scores[1:] = totals[1:] / counts[1:]
+        return scores
+
+    def long_key_lengths(self, max_len):
+        """Returns the most likely key lengths from MAX_SHORT_KEY_LENGTH to max_len, shortest first. Returns an empty
+        list if a shorter length is more likely, as multiples of the real length score as well as the real length"""
+        if max_len < MAX_SHORT_KEY_LENGTH:
+            return []
+        scores = self.period_scores(max_len)
+        best_score = scores[2:].max()
+        likely = numpy.flatnonzero(scores >= RANDOM_COINCIDENCE + LONG_KEY_THRESHOLD * (best_score - RANDOM_COINCIDENCE))
+        likely = likely[likely >= 2]
+        if len(likely) == 0 or likely[0] < MAX_SHORT_KEY_LENGTH:
+            return []
+        lengths = []
+        for key_len in likely.tolist():
+            if all(key_len % length != 0 for length in lengths):
+                lengths.append(key_len)
+                if len(lengths) == LONG_KEY_CANDIDATES:
+                    break
+        return lengths
+
+    def frequency_key(self, key_len):
+        """ Finds the key which is `key_len` long where each column decrypts to the most likely english letters """
+        # scores[shift, letter] = the score of the letter decrypted with the shift
+        shifts = (numpy.arange(26)[None, :] - numpy.arange(26)[:, None]) % 26
+        totals = self.letter_counts(key_len).dot(unigram_table[shifts].T)
+        return "".join(ascii_uppercase[shift] for shift in totals.argmin(axis=1))
+
+    def long_key(self, key_len):
+        """ Finds a key which is `key_len` long from the letter frequencies of each column, then refines it using the
+        4gram score of the whole text """
+        return refine_key(self.codes, self.frequency_key(key_len))
+
+    def best_key(self, key_len):
+        """ Finds the best key for the ciphertext which is `key_len` long """
+        pair_counts = self.pair_counts(key_len)
+        # the total score of every key pair in every column is the sum of the score of each cipher letter pair decrypted
+        # with the keys multiplied by how often it occurs. totals[key_index, key1 * 26 + key2]
+        totals = pair_counts.dot(self.pair_scores.T)
+        counts = pair_counts.sum(axis=1)
+        # array to store the best two keys for each position
+        key_possibilities = [[] for _ in range(key_len)]
+        # for each position in the key
+        for key_index in range(key_len):
+            # the first pair with the lowest total in the order key1, key2 = AA, AB, ..., ZZ
+            best_total = totals[key_index].min()
+            best = numpy.flatnonzero(totals[key_index] <= best_total + TIE_TOLERANCE * abs(best_total))[0]
+            best_average = totals[key_index, best] / counts[key_index]
+            # store the best key letter 1 & 2 in the relevant positions
+            key_possibilities[key_index].append((ascii_uppercase[best // 26], best_average))
+            # if this is the last key index the second letter is actually the
+            # first key index as the key is repeated
+            key_index2 = (key_index + 1) % key_len
+            key_possibilities[key_index2].append((ascii_uppercase[best % 26], best_average))
+        # make a key from the best letter from each position
+        key = ""
+        for letter_possibilities in key_possibilities:
+            # sort the possibility by the average score
+            letter_possibilities.sort(key=lambda x: x[1])
+            # add the letter from the possibility with the lowest score to the key
+            key += letter_possibilities[0][0]
+        return key
+
+    def refined_key(self, key_len):
+        """ Finds the best key which is `key_len` long, then refines it using the 4gram score of the decrypted text """
+        key = self.best_key(key_len)
+        if len(self.codes) < REFINE_MIN_COLUMN_LENGTH * key_len or self.english_fraction(key_len) < REFINE_MIN_ENGLISH:
+            return key
+        return refine_key(self.codes[:REFINE_MAX_LENGTH], key)
+
+
+def best_n_long_key(codes, table, key_len):
+    """ Finds the best key for the ciphertext which is `key_len` long. codes is the ciphertext as an array of letter
+    codes and table is the 26x26 bigram score table """
+    return VigenereAnalysis(codes, table).best_key(key_len)
+
+
+def independent_key_indexes(key_len, n=4):
+    """Splits the indexes of a key into groups where no two indexes in a group decrypt letters of the same `n` long
+    pattern, so the letters of a group can all be changed at once without affecting each other's scores"""
+    # indexes n apart never share a pattern. the indexes after the last multiple of n are close to the start of the key
+    # when it repeats, so they each go in a group of their own
+    full = key_len - key_len % n if key_len >= 2 * n else 0
+    groups = [numpy.arange(offset, full, n) for offset in range(min(n, full))]
+    return groups + [numpy.array([key_index]) for key_index in range(full, key_len)]
+
+
+class VigenereScorer:
+    """Keeps track of the total ngram score of a text decrypted with a Vigenère key as the letters of the key are
+    changed. Changing a group of key letters only re-scores the patterns containing letters they decrypt instead of the
+    whole text"""
+
+    def __init__(self, codes, key, ngram_data=None):
+        self.ngram_data = get_ngram_data(4) if ngram_data is None else ngram_data
+        n = self.ngram_data.n
+        self.codes = numpy.asarray(codes, dtype=numpy.intp)
+        # the position in the text of every letter of each pattern, and which key letter decrypts it
+        self.windows = numpy.arange(max(0, len(self.codes) - n + 1))[:, None] + numpy.arange(n)[None, :]
+        self.window_key_indexes = self.windows % len(key)
+        self.set_key(key)
+
+    def set_key(self, key):
+        """Replace the key (a list of shifts), re-scoring every pattern"""
+        self.key = numpy.array(key, dtype=numpy.intp)
+        self.plain = (self.codes - self.key[numpy.arange(len(self.codes)) % len(self.key)]) % 26
+        self.pattern_scores = self.ngram_data.lookup(ngram_indexes(self.plain, self.ngram_data.n))
+        self.total_score = float(self.pattern_scores.sum())
+
+    def group_patterns(self, key_indexes):
+        """Returns (the patterns containing letters decrypted by the key indexes, the position in key_indexes of the
+        key index each pattern contains, a mask of which letters of each pattern it decrypts)"""
+        group_positions = numpy.full(len(self.key), -1, dtype=numpy.intp)
+        group_positions[key_indexes] = numpy.arange(len(key_indexes))
+        window_positions = group_positions[self.window_key_indexes]
+        patterns = numpy.flatnonzero((window_positions >= 0).any(axis=1))
+        window_positions = window_positions[patterns]
+        return patterns, window_positions.max(axis=1), window_positions >= 0
+
+    def group_totals(self, key_indexes):
+        """Returns an array[shift, i] of the total score if the key letter at key_indexes[i] was each of the 26 shifts.
+        No two of the key indexes can decrypt letters of the same pattern"""
+        n = self.ngram_data.n
+        # the value of each letter in the base 26 index of a pattern
+        place_values = 26 ** numpy.arange(n - 1, -1, -1)
+        patterns, group_positions, changed = self.group_patterns(key_indexes)
+        changes = numpy.zeros(26 * len(key_indexes))
+        shifts = numpy.arange(26)[:, None]
+        # score the patterns in blocks to limit the size of the arrays of every shift of every pattern
+        for start in range(0, len(patterns), REFINE_BLOCK_SIZE):
+            block = slice(start, start + REFINE_BLOCK_SIZE)
+            windows = self.windows[patterns[block]]
+            block_changed = changed[block]
+            # the index of each pattern without the letters decrypted by the key letter, then add the letters on for
+            # every shift at once
+            unchanged_indexes = (numpy.where(block_changed, 0, self.plain[windows]) * place_values).sum(axis=1)
+            indexes = numpy.repeat(unchanged_indexes[None, :], 26, axis=0)
+            for i in range(n):
+                rows = numpy.flatnonzero(block_changed[:, i])
+                indexes[:, rows] += place_values[i] * ((self.codes[windows[rows, i]][None, :] - shifts) % 26)
+            new_scores = self.ngram_data.lookup(indexes) - self.pattern_scores[patterns[block]]
+            # add up the change in score of each key letter for each shift
+            bins = shifts * len(key_indexes) + group_positions[block]
+            changes += numpy.bincount(bins.ravel(), weights=new_scores.ravel(), minlength=len(changes))
+        return self.total_score + changes.reshape(26, len(key_indexes))
+
+    def set_letters(self, key_indexes, shifts):
+        """Change the key letters at key_indexes, updating only the affected patterns"""
+        self.key[key_indexes] = shifts
+        positions = numpy.flatnonzero(numpy.isin(numpy.arange(len(self.codes)) % len(self.key), key_indexes))
+        self.plain[positions] = (self.codes[positions] - self.key[positions % len(self.key)]) % 26
+        patterns = self.group_patterns(key_indexes)[0]
+        new_scores = self.ngram_data.lookup(ngram_indexes(self.plain[self.windows[patterns]], self.ngram_data.n)[:, 0])
+        self.total_score += float((new_scores - self.pattern_scores[patterns]).sum())
+        self.pattern_scores[patterns] = new_scores
+
+
+def refine_key(codes, key, ngram_data=None):
+    """Hill climbs the key (a string) using the 4gram score of the whole decrypted text, until no single letter change
+    makes the text more likely. Letters which don't decrypt letters of the same patterns are changed together. Returns
+    the refined key"""
+    ngram_data = get_ngram_data(4) if ngram_data is None else ngram_data
+    if len(codes) < ngram_data.n:
+        # too short to have any patterns to score
+        return key
+    scorer = VigenereScorer(codes, string_to_shifts(key), ngram_data)
+    groups = independent_key_indexes(len(key), ngram_data.n)
+    # the key letters which could have a better shift. once a letter has been tried it only needs trying again if a
+    # letter next to it, which decrypts letters of the same patterns, is changed
+    active = numpy.ones(len(key), dtype=bool)
+    neighbours = numpy.concatenate((numpy.arange(1 - ngram_data.n, 0), numpy.arange(1, ngram_data.n)))
+    for _ in range(REFINE_PASSES):
+        if not active.any():
+            break
+        for key_indexes in groups:
+            key_indexes = key_indexes[active[key_indexes]]
+            if len(key_indexes) == 0:
+                continue
+            active[key_indexes] = False
+            totals = scorer.group_totals(key_indexes)
+            best = totals.argmin(axis=0)
+            columns = numpy.arange(len(key_indexes))
+            # only change the letters which are clearly better, not just the same total rounded differently
+            better = totals[best, columns] < totals[scorer.key[key_indexes], columns] - TIE_TOLERANCE * abs(scorer.total_score)
+            if better.any():
+                scorer.set_letters(key_indexes[better], best[better])
+                active[(key_indexes[better][:, None] + neighbours[None, :]) % len(key)] = True
+    return "".join(ascii_uppercase[shift] for shift in scorer.key)
+
+
+def vigenere_worker_init(codes):
+    """ Entry point for the worker processes of a parallel VigenereSolver. Each worker counts the columns itself """
+    global _worker_analysis
+    _worker_analysis = VigenereAnalysis(codes)
+
+
+def vigenere_worker_key(task):
+    """ Finds the best key which is `key_len` long in a worker process """
+    key_len, refine = task
+    return _worker_analysis.refined_key(key_len) if refine else _worker_analysis.best_key(key_len)
+
+
 class VigenereSolver(SolverProcess):
     """ Automatic key finder for the Vigenère Cipher """
 
-    def __init__(self):
-        super(VigenereSolver, self).__init__("Vigenère Cipher")
+    def __init__(self, config=None, processes=1, refine=True, long_keys=True):
+        super(VigenereSolver, self).__init__("Vigenère Cipher", config)
+        # whether to hill climb each key using 4grams after finding it from the bigrams of each column
+        self.refine = refine
+        # whether to look for keys of MAX_SHORT_KEY_LENGTH or more if none of the shorter keys are found twice
+        self.long_keys = long_keys
+        # the number of worker processes to find the keys of each length in. None means one per cpu, 1 finds them in
+        # this process, which is usually fastest as each length only takes a few milliseconds once the text is counted
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.uses_worker_processes = self.processes > 1
 
     def run(self, text):
         """ Run the automatic key finding """
+        self.start_run()
         # strip all non letter characters
         letters_only = letters_only_uppercase(text)
-        # all the possible lengths to test
-        lengths = list(range(2, min(50, len(letters_only))))
+        # counts of the letters in each column, shared by every key length
+        analysis = VigenereAnalysis(text_to_codes(letters_only))
+        # all the possible lengths to test, most likely first
+        lengths = analysis.rank_key_lengths(list(range(2, min(MAX_SHORT_KEY_LENGTH, len(letters_only)))))
         # set the number of possibilities
         self.set_total_possibilities(len(lengths))
-        # pre-calculate the entire text decrypted with all the caesar shifts
-        reverse_caesars = {}
-        for shift, letter in enumerate(ascii_uppercase):
-            reverse_caesars[letter] = caesar(letters_only, -shift)
         # store the found keys
         found_keys = set()
-        # iterate over each length to check
-        for length in lengths:
-            # try and find the best key that is `length` long
-            key = best_n_long_key(letters_only, reverse_caesars, length)
-            shifts = string_to_shifts(key)
-            # check if key is double an existing key
-            if len(key) % 2 == 0:
-                first_half = key[:len(key) // 2]
-                second_half = key[len(key) // 2:]
-                if first_half == second_half and first_half in found_keys:
-                    # this new key is double an existing key, the solver is done
-                    self.done()
-                    return
-            found_keys.add(key)
-            self.possibility(key, reverse_vigenere(text, shifts))
+        if self.processes > 1:
+            # imap returns the keys in the same order as the lengths. leaving the pool terminates the workers, which
+            # cancels the lengths which haven't been tried when the solver stops early
+            with multiprocessing.Pool(self.processes, vigenere_worker_init, (analysis.codes,)) as pool:
+                stopped = self.try_keys(text, analysis, pool.imap(vigenere_worker_key, [(length, self.refine) for length in lengths]), found_keys)
+        else:
+            stopped = self.try_keys(text, analysis, map(analysis.refined_key if self.refine else analysis.best_key, lengths), found_keys)
+        if not stopped and self.long_keys:
+            # none of the short keys were found twice, so try long keys if the text is long enough to find them
+            long_lengths = analysis.long_key_lengths(len(letters_only) // LONG_KEY_MIN_COLUMN_LENGTH)
+            if long_lengths:
+                self.set_total_possibilities(len(lengths) + len(long_lengths))
+                self.try_keys(text, analysis, map(analysis.long_key, long_lengths), found_keys)
         self.done()
 
+    def try_keys(self, text, analysis, keys, found_keys):
+        """ Decrypt the text with each key until the same key is found at two lengths. Returns True if the solver should
+        stop. A key found twice only counts if its columns are english, as lengths sharing a factor with a long key can
+        give the same wrong key, e.g. lengths 20 and 40 of a key 60 long both give a key 20 long """
+        # iterate over the best key of each length
+        for key in keys:
+            if self.should_stop():
+                return True
+            # multiples of the real length give the real key repeated
+            key = shortest_repeat(key)
+            shifts = string_to_shifts(key)
+            # check if the key has already been found at another length
+            if key in found_keys and analysis.english_fraction(len(key)) >= REPEATED_KEY_MIN_ENGLISH:
+                # the key has been found at two lengths, the solver is done
+                return True
+            found_keys.add(key)
+            self.possibility(key, decrypt(text, shifts))
+        return False
@@ -11,11 +11,22 @@ for letter in ascii_letters:
     string_uppercase_strip_mapping[ord(letter)] = letter.upper()
 
 
+# build letters only mapping for bytes. every byte which isn't an ascii letter is deleted
+bytes_uppercase_mapping = bytes.maketrans(ascii_letters.encode("ascii"), ascii_letters.upper().encode("ascii"))
+bytes_non_letters = bytes(i for i in range(256) if chr(i) not in ascii_letters)
+
+
 def letters_only_uppercase(text):
     """Converts the text to uppercase and strips any non-letter characters"""
     return text.translate(string_uppercase_strip_mapping)
 
 
+def letters_only_uppercase_bytes(data):
+    """The same as letters_only_uppercase but for ascii or utf-8 encoded bytes, returning bytes"""
+    # utf-8 only uses bytes >= 128 for non ascii characters, so they are always stripped
+    return data.translate(bytes_uppercase_mapping, bytes_non_letters)
+
+
 def greatest_common_divisor(a, b):
     """Returns the greatest common divisor of a & b"""
     while a != 0:
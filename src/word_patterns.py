@@ -0,0 +1,110 @@
+import math
+import re
+
+from ngrams import NGRAM_DATA_PATH
+
+# list of common words, one uppercase word per line
+WORD_LIST_PATH = NGRAM_DATA_PATH + "WORDS.txt"
+# words in the text. apostrophes are removed, so "don't" is the word DONT
+WORD_REGEX = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*")
+# the word list is ordered most common first. the probability of the word at rank r is estimated as
+# ZIPF_CONSTANT / (r + 1), and the probability of a word which isn't in the list as UNKNOWN_WORD_PROBABILITY
+ZIPF_CONSTANT = 0.1
+UNKNOWN_WORD_PROBABILITY = 1e-4
+# partial_key() keeps the BEAM_WIDTH most likely keys, tries up to BEAM_BRANCHES candidates for each word and uses
+# the MAX_SEARCH_WORDS words in the text which could make it the most likely
+BEAM_WIDTH = 20
+BEAM_BRANCHES = 5
+MAX_SEARCH_WORDS = 100
+# cache word patterns so they do not have to be reloaded every time
+_cached_word_patterns = {}
+
+
+def word_pattern(word):
+    """Returns the letter repetition pattern of a word. The first letter is A, the next different letter is B, etc.
+    e.g. HELLO -> ABCCD, THAT -> ABCA"""
+    letters = {}
+    return "".join(letters.setdefault(letter, chr(65 + len(letters))) for letter in word)
+
+
+def word_counts(text):
+    """Returns a dictionary of word:count of the words in the text, uppercase without apostrophes"""
+    counts = {}
+    for word in WORD_REGEX.findall(text):
+        word = word.replace("'", "").upper()
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class WordPatterns:
+    """Word list indexed by the letter repetition pattern of each word"""
+
+    def __init__(self, path=None):
+        path = WORD_LIST_PATH if path is None else path
+        # {pattern: [(word as a tuple of letter codes, log probability of the word)]}, most common first
+        self.words = {}
+        rank = 0
+        with open(path, "r") as f:
+            for line in f:
+                word = line.strip().upper()
+                if word.isalpha():
+                    codes = tuple(ord(letter) - 65 for letter in word)
+                    self.words.setdefault(word_pattern(word), []).append((codes, math.log(ZIPF_CONSTANT / (rank + 1))))
+                    rank += 1
+
+    def candidates(self, word):
+        """Returns the words in the list with the same pattern as the word as (letter codes, log probability), most common first"""
+        return self.words.get(word_pattern(word), [])
+
+
+def get_word_patterns(path=None):
+    """Returns the WordPatterns for the word list. Caches the instances so the list doesn't have to be repeatedly loaded from disk"""
+    if path not in _cached_word_patterns:
+        _cached_word_patterns[path] = WordPatterns(path)
+    return _cached_word_patterns[path]
+
+
+def partial_key(text, word_patterns=None):
+    """Returns {cipher letter code: plain letter code} found by matching the words of the text to words in the list with
+    the same pattern. Searches for the most likely consistent matches, so words which don't fit the other words, e.g. names
+    which aren't in the word list, are left out"""
+    word_patterns = get_word_patterns() if word_patterns is None else word_patterns
+    # (letter codes, [(candidate, gain)]) of each word. the gain is how much more likely the text is if the word is the
+    # candidate instead of a word which isn't in the list
+    words = []
+    for word, count in word_counts(text).items():
+        codes = tuple(ord(letter) - 65 for letter in word)
+        candidates = [(candidate, count * (log_probability - math.log(UNKNOWN_WORD_PROBABILITY)))
+                      for candidate, log_probability in word_patterns.candidates(word)]
+        if candidates:
+            words.append((codes, candidates))
+    # match the words which could gain the most first
+    words.sort(key=lambda x: x[1][0][1], reverse=True)
+    words = words[:MAX_SEARCH_WORDS]
+    # beam search: keep the most likely partial keys as (gain, plain letter of each cipher letter) after matching each
+    # word. -1 means the cipher letter hasn't been matched yet
+    beam = [(0, (-1,) * 26)]
+    for codes, candidates in words:
+        expanded = []
+        for gain, key in beam:
+            # leave the word out
+            expanded.append((gain, key))
+            used = set(key)
+            branches = 0
+            for candidate, candidate_gain in candidates:
+                # check each cipher letter is only one plain letter and the other way round
+                new_key = list(key)
+                for code, plain in zip(codes, candidate):
+                    if new_key[code] == -1 and plain not in used:
+                        new_key[code] = plain
+                    elif new_key[code] != plain:
+                        break
+                else:
+                    expanded.append((gain + candidate_gain, tuple(new_key)))
+                    branches += 1
+                    if branches == BEAM_BRANCHES:
+                        break
+        # remove duplicates and keep the best
+        beam = sorted(set(expanded), reverse=True)[:BEAM_WIDTH]
+    gain, key = beam[0]
+    return {code: plain for code, plain in enumerate(key) if plain != -1}
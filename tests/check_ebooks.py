@@ -1,3 +1,4 @@
+import functools
 import multiprocessing
 import os
 import queue
@@ -7,6 +8,7 @@ from string import ascii_uppercase
 
 from tqdm import tqdm
 
+import ngrams
 from solvers.affine import AffineSolver, POSSIBLE_VALUES_A, affine
 from solvers.caesar import CaesarSolver, caesar
 from solvers.scytale import ScytaleSolver, scytale
@@ -124,7 +126,8 @@ class SubstitutionChecker(SolverChecker):
     """ Tests the Substitution Solver"""
 
     def __init__(self):
-        super(SubstitutionChecker, self).__init__("Substitution", SubstitutionSolver)
+        # the solver runs in a pool worker, which can't start its own worker processes
+        super(SubstitutionChecker, self).__init__("Substitution", functools.partial(SubstitutionSolver, processes=1))
 
     def get_ciphertext_key(self, text):
         letters = list(ascii_uppercase)
@@ -148,8 +151,8 @@ def get_strings(full_path):
 
 
 if __name__ == "__main__":
-    # start a thread pool
-    pool = multiprocessing.Pool(processes=8)
+    # start a process pool. each worker attaches to the ngram data loaded by this process instead of loading its own copy
+    pool = multiprocessing.Pool(processes=8, initializer=ngrams.attach_ngram_data, initargs=(ngrams.publish_ngram_data(),))
     # directory containing the texts to test is the first command line argument
     input_dir = sys.argv[1]
     # list to store the texts
@@ -0,0 +1,94 @@
+import collections
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+from ngram_builder import NgramCounter, build_ngram_data, count_corpus, count_range, merge_counts
+from ngrams import NgramCounts, NgramData, NgramRegistry, SparseNgramData, ngram_counts
+
+
+class TestNgramBuilder(unittest.TestCase):
+
+    def test_merge_counts(self):
+        indexes, counts = merge_counts([numpy.array([5, 1]), numpy.array([1, 3])], [numpy.array([2, 1]), numpy.array([4, 1])])
+        self.assertEqual(list(indexes), [1, 3, 5])
+        self.assertEqual(list(counts), [5, 1, 2])
+
+    def test_ngram_counter(self):
+        text = "ITWASTHEBESTOFTIMESITWASTHEWORSTOFTIMES"
+        counter = NgramCounter(5)
+        # patterns spanning chunks, chunks shorter than n and empty chunks
+        for chunk in ("ITWA", "S", "", "THEBESTOFTIMESITWASTH", "EWORSTOFTIMES"):
+            counter.feed(chunk.encode("ascii"))
+        for n, (indexes, counts) in counter.results().items():
+            self.assertEqual(NgramCounts(indexes, counts, n).to_dict(), ngram_counts(text, n).to_dict())
+
+    def test_ngram_counter_tail(self):
+        # only the patterns starting before the tail are counted
+        counter = NgramCounter(3)
+        counter.feed(b"ABCD")
+        counter.feed(b"EF", tail=True)
+        results = counter.results()
+        self.assertEqual(NgramCounts(*results[3], 3).to_dict(), {"ABC": 1, "BCD": 1, "CDE": 1, "DEF": 1})
+        self.assertEqual(NgramCounts(*results[2], 2).to_dict(), {"AB": 1, "BC": 1, "CD": 1, "DE": 1})
+        self.assertEqual(NgramCounts(*results[1], 1).to_dict(), {"A": 1, "B": 1, "C": 1, "D": 1})
+
+    def test_count_corpus(self):
+        texts = ["It was the best of times, it was the worst of times!\n", "The age of wisdom... the age of foolishness"]
+        input_dir = tempfile.mkdtemp()
+        try:
+            for i, text in enumerate(texts):
+                with open(os.path.join(input_dir, "{}.txt".format(i)), "w") as f:
+                    f.write(text)
+            # a range counts the patterns starting in it, reading past its end for the patterns which span two ranges
+            path = os.path.join(input_dir, "0.txt")
+            first, second = count_range((path, 0, 10, 5)), count_range((path, 10, len(texts[0]), 5))
+            for n in range(1, 6):
+                indexes, counts = merge_counts([first[n][0], second[n][0]], [first[n][1], second[n][1]])
+                self.assertEqual(NgramCounts(indexes, counts, n).to_dict(), ngram_counts(texts[0], n).to_dict())
+            # files split into many small ranges give the same counts as counting each file in one pass
+            progress = []
+            with mock.patch("ngram_builder.RANGE_SIZE", 7):
+                totals = count_corpus(input_dir, 5, processes=2, progress=lambda *args: progress.append(args))
+            self.assertEqual(progress[-1], (15, 15))
+            for n, (indexes, counts) in totals.items():
+                expected = collections.Counter()
+                for text in texts:
+                    expected.update(ngram_counts(text, n).to_dict())
+                self.assertEqual(NgramCounts(indexes, counts, n).to_dict(), dict(expected))
+        finally:
+            shutil.rmtree(input_dir)
+
+    def test_build_ngram_data(self):
+        text = "It was the best of times, it was the worst of times, it was the age of wisdom"
+        input_dir = tempfile.mkdtemp()
+        output_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(input_dir, "text.txt"), "w") as f:
+                f.write(text)
+            cache_paths = build_ngram_data(input_dir, output_dir, 5, processes=1)
+            registry = NgramRegistry()
+            registry.register_corpus("built", output_dir)
+            for n in range(1, 6):
+                counts = ngram_counts(text, n).to_dict()
+                total = sum(counts.values())
+                # the NGRAM.txt file has the count of every pattern in the corpus
+                text_data = NgramData(n, output_dir)
+                for key, count in counts.items():
+                    self.assertAlmostEqual(text_data.get_score(key), -math.log10(count / total))
+                # the binary cache built from it loads through the registry and gives the same scores
+                array_data = registry.get(n, "built")
+                self.assertIn(array_data.cache_path, cache_paths)
+                self.assertEqual(array_data.avg, text_data.avg)
+                for key in list(counts) + ["Q" * n]:
+                    self.assertEqual(array_data.get_score(key), text_data.get_score(key))
+            self.assertEqual(len(cache_paths), 5)
+            self.assertIsInstance(registry.get(5, "built"), SparseNgramData)
+        finally:
+            shutil.rmtree(input_dir)
+            shutil.rmtree(output_dir)
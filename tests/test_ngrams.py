@@ -0,0 +1,217 @@
+import io
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+import ngrams
+from ciphers.substitution import substitution
+from ngrams import DenseNgramData, SparseNgramData, NgramRegistry, get_ngram_data, text_to_codes, ngram_indexes, ngram_counts, rate, rate_from_counts, rate_many, rate_bounded, rate_stream, NgramStream
+from ciphers.caesar import caesar
+
+SAMPLE_TEXT = "It was the best of times, it was the worst of times, it was the age of wisdom, it was the age of foolishness"
+
+
+class TestNgrams(unittest.TestCase):
+
+    def test_text_to_codes(self):
+        self.assertEqual(list(text_to_codes("Hello World")), [7, 4, 11, 11, 14, 22, 14, 17, 11, 3])
+        self.assertEqual(list(text_to_codes("a1z!")), [0, 25])
+        self.assertEqual(len(text_to_codes("123")), 0)
+
+    def test_ngram_indexes(self):
+        self.assertEqual(list(ngram_indexes(text_to_codes("ABCD"), 2)), [1, 28, 55])
+        self.assertEqual(list(ngram_indexes(text_to_codes("ZZZ"), 3)), [26 ** 3 - 1])
+        # the longest patterns which fit in 64 bit indexes
+        self.assertEqual(list(ngram_indexes(text_to_codes("Z" * 13), 13)), [26 ** 13 - 1])
+        with self.assertRaises(ValueError):
+            ngram_indexes(text_to_codes("Z" * 14), 14)
+        with self.assertRaises(ValueError):
+            ngrams.ngram_data_class(14)
+
+    def test_dense_rate(self):
+        for n in range(1, 5):
+            ngram_data = get_ngram_data(n, use_numpy=False)
+            dense_ngram_data = get_ngram_data(n)
+            for text in ("", "abc", "Hello World", SAMPLE_TEXT, SAMPLE_TEXT.upper() * 10):
+                self.assertEqual(dense_ngram_data.rate(text), ngram_data.rate(text))
+
+    def test_ngram_cache(self):
+        original_path = ngrams.NGRAM_DATA_PATH
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ngrams.NGRAM_DATA_PATH = temp_dir + "/"
+            try:
+                shutil.copy(original_path + "2GRAM.txt", temp_dir)
+                # the cache should be built the first time the data is loaded
+                first = DenseNgramData(2)
+                self.assertTrue(os.path.isfile(temp_dir + "/2GRAM.bin"))
+                self.assertEqual(first.rate(SAMPLE_TEXT), get_ngram_data(2).rate(SAMPLE_TEXT))
+                # and rebuilt when the text file changes
+                with open(temp_dir + "/2GRAM.txt", "w") as f:
+                    f.write("AB 1\nCD 3\n")
+                second = DenseNgramData(2)
+                self.assertAlmostEqual(second.get_score("CD"), -math.log10(3 / 4))
+                self.assertEqual(second.get_score("TH"), second.score_other)
+            finally:
+                ngrams.NGRAM_DATA_PATH = original_path
+
+    def test_publish_attach(self):
+        published = ngrams.publish_ngram_data((2, 4))
+        self.assertEqual(sorted(published.keys()), [("english", 2), ("english", 4)])
+        # attaching to a published cache should score identically to loading it normally
+        attached = DenseNgramData(4, published["english", 4][0])
+        self.assertEqual(attached.rate(SAMPLE_TEXT), get_ngram_data(4).rate(SAMPLE_TEXT))
+        # the attached table is read only
+        self.assertFalse(attached.table.flags.writeable)
+        self.assertEqual(published["english", 4][1], None)
+
+    def test_attach_corpus(self):
+        data_path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_path, "2GRAM.txt"), "w") as f:
+                f.write("AB 3\nBA 1\n")
+            with mock.patch.object(ngrams, "registry", NgramRegistry()):
+                ngrams.register_corpus("test", data_path)
+                published = ngrams.publish_ngram_data((2,), "test")
+                score = get_ngram_data(2, corpus="test").get_score("AB")
+            # a child process which hasn't registered the corpus gets its folder from the published data
+            with mock.patch.object(ngrams, "registry", NgramRegistry()):
+                ngrams.attach_ngram_data(published)
+                self.assertEqual(ngrams.registry.corpora["test"], data_path)
+                self.assertEqual(get_ngram_data(2, corpus="test").get_score("AB"), score)
+                # once evicted the data is reloaded from the same corpus
+                ngrams.registry.loaded.clear()
+                self.assertEqual(get_ngram_data(2, corpus="test").get_score("AB"), score)
+        finally:
+            shutil.rmtree(data_path)
+
+    def test_registry(self):
+        data_path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_path, "1GRAM.txt"), "w") as f:
+                f.write("A 3\nB 1\n")
+            with open(os.path.join(data_path, "2GRAM.txt"), "w") as f:
+                f.write("AB 3\nBA 1\n")
+            registry = NgramRegistry()
+            registry.register_corpus("test", data_path)
+            first = registry.get(1, "test")
+            self.assertIs(registry.get(1, "test"), first)
+            self.assertAlmostEqual(first.get_score("A"), -math.log10(3 / 4))
+            self.assertEqual(registry.stats()["hits"], 1)
+            self.assertEqual(registry.stats()["misses"], 1)
+            # the dictionary based data can be loaded from a corpus too
+            self.assertEqual(registry.get(2, "test", use_numpy=False).get_score("AB"), first.get_score("A"))
+            with self.assertRaises(ValueError):
+                registry.get(1, "unknown")
+            # only allow room for the largest table, so the least recently used data is evicted
+            registry.pin(2, "test")
+            registry.set_memory_budget(registry.get(2, "test").memory_size())
+            self.assertEqual(list(registry.loaded), [("test", 2, True)])
+            self.assertEqual(registry.evictions, 2)
+            # pinned data is kept even when the memory budget is exceeded
+            registry.get(1, "test")
+            self.assertEqual(sorted(registry.loaded), [("test", 1, True), ("test", 2, True)])
+            registry.unpin(2, "test")
+            self.assertEqual(list(registry.loaded), [("test", 1, True)])
+        finally:
+            shutil.rmtree(data_path, ignore_errors=True)
+
+    def test_interpolated(self):
+        interpolated = ngrams.get_interpolated_ngram_data()
+        # the same as rating with each pattern length separately
+        expected = sum(weight * rate(SAMPLE_TEXT, n) for n, weight in ngrams.INTERPOLATION_WEIGHTS.items())
+        self.assertAlmostEqual(interpolated.rate(SAMPLE_TEXT), expected / sum(ngrams.INTERPOLATION_WEIGHTS.values()))
+        # pattern lengths longer than the text are left out
+        self.assertAlmostEqual(interpolated.rate("THE"), (0.1 * rate("THE", 1) + 0.2 * rate("THE", 2) + 0.3 * rate("THE", 3)) / 0.6)
+        self.assertEqual(interpolated.rate(""), 0)
+        self.assertEqual(interpolated.rate_many(["ABC", SAMPLE_TEXT]), [interpolated.rate("ABC"), interpolated.rate(SAMPLE_TEXT)])
+        self.assertAlmostEqual(ngrams.rate_interpolated(SAMPLE_TEXT, {2: 1}), rate(SAMPLE_TEXT, 2))
+
+    def test_rate_from_counts(self):
+        mapping = {"A": "Q", "Q": "A", "E": "T", "T": "E", "H": "Z"}
+        counts = ngram_counts(SAMPLE_TEXT)
+        self.assertAlmostEqual(rate_from_counts(counts, mapping), rate(substitution(SAMPLE_TEXT, mapping)))
+        # a dictionary of pattern:count can be used instead
+        self.assertEqual(ngram_counts("ABABC", 2).to_dict(), {"AB": 2, "BA": 1, "BC": 1})
+        self.assertAlmostEqual(rate_from_counts({"AB": 2, "BA": 1, "BC": 1}, mapping, 2), rate(substitution("ABABC", mapping), 2))
+        # too short texts score 0 like rate()
+        self.assertEqual(rate_from_counts(ngram_counts("ABC"), mapping), 0)
+
+    def test_substitution_scorer(self):
+        mapping = {letter: letter for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+        scorer = ngrams.SubstitutionScorer(get_ngram_data(4), ngram_counts(SAMPLE_TEXT), mapping)
+        self.assertAlmostEqual(scorer.score, rate(SAMPLE_TEXT))
+        # scoring a swap should not change the mapping
+        mapping["E"], mapping["T"] = "T", "E"
+        self.assertAlmostEqual(scorer.score_after_swap(4, 19), rate(substitution(SAMPLE_TEXT, mapping)))
+        self.assertEqual(list(scorer.mapping[[4, 19]]), [4, 19])
+        # applying the swap should
+        scorer.apply_swap(4, 19)
+        self.assertEqual(list(scorer.mapping[[4, 19]]), [19, 4])
+        self.assertAlmostEqual(scorer.score, rate(substitution(SAMPLE_TEXT, mapping)))
+        self.assertEqual(scorer.swap_delta(0, 0), 0)
+
+    def test_rate_many(self):
+        texts = ["", "abc", "Hello World", "Dlrow Olleh", SAMPLE_TEXT]
+        self.assertEqual(rate_many(texts), [rate(text) for text in texts])
+        # equal length rows of letter codes
+        rows = numpy.array([text_to_codes("Hello World"), text_to_codes("Dlrow Olleh")])
+        self.assertEqual(list(get_ngram_data(4).rate_code_rows(rows)), [rate("Hello World"), rate("Dlrow Olleh")])
+
+    def test_rate_bounded(self):
+        long_text = SAMPLE_TEXT * 20
+        # the bound uses the lowest score of the patterns in the data set, not counting patterns which aren't in it
+        ngram_data = get_ngram_data(4)
+        self.assertNotIn(ngram_data.score_other, ngram_data.known_scores())
+        self.assertEqual(ngram_data.min_score, ngram_data.table.min())
+        # texts which can beat the threshold are rated exactly
+        self.assertEqual(rate_bounded(long_text, 1), (rate(long_text), False))
+        self.assertEqual(rate_bounded("abc", 1), (0, False))
+        # texts which can't whatever the rest of the text is are given up on
+        score, aborted = rate_bounded("Q" * 5000, 0.5)
+        self.assertTrue(aborted)
+        self.assertGreater(score, 0.5)
+        # texts which could still beat the threshold are only given up on if estimating is allowed
+        self.assertEqual(rate_bounded(caesar(long_text, 3), 2), (rate(caesar(long_text, 3)), False))
+        score, aborted = rate_bounded(caesar(long_text, 3), 2, estimate=True)
+        self.assertTrue(aborted)
+        self.assertGreater(score, 2)
+
+    def test_rate_stream(self):
+        for n in range(1, 5):
+            # chunks which split patterns, contain no letters or are shorter than n
+            chunks = ["It w", "a", "s the ", "123", "best of times"]
+            self.assertEqual(rate_stream(chunks, n), rate("".join(chunks), n))
+        self.assertEqual(rate_stream(io.StringIO(SAMPLE_TEXT)), rate(SAMPLE_TEXT))
+        self.assertEqual(rate_stream([]), 0)
+        # partial scores
+        stream = NgramStream(get_ngram_data(4))
+        self.assertEqual(stream.feed("Hello "), rate("Hello"))
+        self.assertEqual(stream.feed("World"), rate("Hello World"))
+
+    def test_sparse_ngram_data(self):
+        original_path = ngrams.NGRAM_DATA_PATH
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ngrams.NGRAM_DATA_PATH = temp_dir + "/"
+            try:
+                # sparse data should score the same as dense data
+                shutil.copy(original_path + "3GRAM.txt", temp_dir)
+                sparse = SparseNgramData(3)
+                self.assertTrue(os.path.isfile(temp_dir + "/3GRAM.sparse.bin"))
+                self.assertEqual(sparse.rate(SAMPLE_TEXT), get_ngram_data(3).rate(SAMPLE_TEXT))
+                self.assertEqual(sparse.get_score("QXZ"), get_ngram_data(3).get_score("QXZ"))
+                # higher order data is stored sparsely
+                with open(temp_dir + "/5GRAM.txt", "w") as f:
+                    for key, count in ngram_counts(SAMPLE_TEXT, 5).to_dict().items():
+                        f.write("{} {}\n".format(key, count))
+                self.assertIs(ngrams.ngram_data_class(5), SparseNgramData)
+                five_grams = SparseNgramData(5)
+                self.assertAlmostEqual(five_grams.get_score("ITWAS"), -math.log10(4 / ngram_counts(SAMPLE_TEXT, 5).total))
+                self.assertEqual(five_grams.get_score("QQQQQ"), five_grams.score_other)
+                self.assertLess(five_grams.rate(SAMPLE_TEXT), five_grams.rate(caesar(SAMPLE_TEXT, 3)))
+            finally:
+                ngrams.NGRAM_DATA_PATH = original_path
@@ -0,0 +1,309 @@
+import itertools
+import os
+import queue
+import random
+import time
+import unittest
+from string import ascii_uppercase
+from unittest import mock
+
+import numpy
+
+from ciphers.affine import affine, reverse_affine
+from ciphers.caesar import caesar
+from ciphers.vigenere import reverse_vigenere, vigenere
+from ngrams import SubstitutionScorer, get_ngram_data, ngram_counts, rate, text_to_codes
+from solvers.affine import AffineSolver
+from solvers.caesar import CaesarSolver
+from solvers.solver_process import RunConfig
+from solvers.substitution import SubstitutionAnnealer, SubstitutionSolver, VisitedMappings, codes_to_mapping, substitution
+from solvers.vigenere import (RANDOM_COINCIDENCE, VigenereAnalysis, VigenereScorer, VigenereSolver, best_n_long_key,
+                               bigram_table, decrypt, independent_key_indexes, kasiski_distances, refine_key,
+                               shortest_repeat)
+from utilities import letters_only_uppercase
+from word_patterns import WORD_LIST_PATH
+
+SAMPLE_TEXT = ("It was the best of times, it was the worst of times, it was the age of wisdom, it was the age of "
+               "foolishness, it was the epoch of belief, it was the epoch of incredulity, it was the season of Light, it "
+               "was the season of Darkness, it was the spring of hope, it was the winter of despair")
+SAMPLE_MAPPING = dict(zip("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "QWERTYUIOPASDFGHJKLZXCVBNM"))
+# a book used for tests which need more text than SAMPLE_TEXT
+BOOK_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "benchmarks", "sample.txt")
+
+
+def crashing_worker(*args):
+    """ Substitution worker which stops without sending any results """
+    raise SystemExit(1)
+
+
+class TestSolvers(unittest.TestCase):
+
+    def test_substitution_annealer(self):
+        cipher_text = substitution(SAMPLE_TEXT, SAMPLE_MAPPING)
+        scorer = SubstitutionScorer(get_ngram_data(4), ngram_counts(cipher_text), list(range(26)))
+        start_score = scorer.score
+        annealer = SubstitutionAnnealer(scorer, iterations=500, random_generator=random.Random(0))
+        score = annealer.run()
+        # the scorer is left on the best mapping found, which is never worse than the starting mapping
+        self.assertLessEqual(score, start_score)
+        self.assertAlmostEqual(score, scorer.score)
+        # swaps to mappings which have already been rated are skipped
+        self.assertEqual(annealer.evaluations + annealer.visited.hits, 500)
+        # the time limit stops the annealing before any swaps are rated
+        annealer = SubstitutionAnnealer(scorer, time_limit=-1)
+        self.assertEqual(annealer.run(), scorer.score)
+        self.assertEqual(annealer.evaluations, 0)
+
+    def test_visited_mappings(self):
+        scorer = SubstitutionScorer(get_ngram_data(4), ngram_counts(SAMPLE_TEXT), list(range(26)))
+        visited = VisitedMappings(max_size=2)
+        self.assertEqual(visited.score_after_swap(scorer, 0, 1), (scorer.score_after_swap(0, 1), True))
+        self.assertEqual(visited.score_after_swap(scorer, 0, 1), (scorer.score_after_swap(0, 1), False))
+        self.assertEqual(visited.hits, 1)
+        # swapping the same letters from a different mapping is a different mapping
+        scorer.apply_swap(2, 3)
+        self.assertTrue(visited.score_after_swap(scorer, 0, 1)[1])
+        # the least recently used mapping is forgotten
+        visited.score_after_swap(scorer, 4, 5)
+        self.assertEqual(len(visited.scores), 2)
+        scorer.apply_swap(2, 3)
+        self.assertTrue(visited.score_after_swap(scorer, 0, 1)[1])
+
+    def test_substitution_solver(self):
+        # texts as short as SAMPLE_TEXT can score better with a wrong mapping than the right one
+        with open(BOOK_PATH, "r") as f:
+            plain_text = f.read()[10000:14000]
+        cipher_text = substitution(plain_text, SAMPLE_MAPPING)
+        # run in this process and in worker processes
+        for processes in (1, 2):
+            solver = SubstitutionSolver(processes=processes)
+            self.assertEqual(solver.uses_worker_processes, processes > 1)
+            solver.solver_queue = queue.Queue()
+            solver.run(cipher_text)
+            # the outputs are the decryptions using the best mappings found, best first
+            text, mapping, score = solver.outputs[0]
+            self.assertEqual(text, plain_text)
+            self.assertEqual(text, substitution(cipher_text, mapping))
+            self.assertEqual(score, min(output[2] for output in solver.outputs))
+            self.assertEqual(solver.solver_queue.queue[-1], ("done", None))
+
+    def test_crashed_workers(self):
+        # the solver gives up waiting for results once every worker has stopped
+        solver = SubstitutionSolver(processes=2)
+        solver.solver_queue = queue.Queue()
+        with mock.patch("solvers.substitution.substitution_worker", crashing_worker):
+            solver.run(substitution(SAMPLE_TEXT, SAMPLE_MAPPING))
+        self.assertEqual(solver.outputs, [])
+        self.assertEqual(solver.solver_queue.queue[-1], ("done", None))
+
+    def test_run_config(self):
+        cipher_text = substitution(SAMPLE_TEXT, SAMPLE_MAPPING)
+        # the same seed gives the same outputs
+        outputs = []
+        for i in range(2):
+            solver = SubstitutionSolver(RunConfig(max_evaluations=3000, target_score=0, seed=1), processes=1)
+            solver.solver_queue = queue.Queue()
+            solver.run(cipher_text)
+            outputs.append(solver.outputs)
+            # the run stops when the evaluations run out
+            self.assertEqual(solver.evaluations, 3000)
+        self.assertEqual(outputs[0], outputs[1])
+        # the worker processes share the evaluations between them, and seeded runs don't use worker processes
+        solver = SubstitutionSolver(RunConfig(max_evaluations=3000, target_score=0), processes=4)
+        solver.solver_queue = queue.Queue()
+        solver.run(cipher_text)
+        self.assertEqual(solver.evaluations, 3000)
+        self.assertFalse(SubstitutionSolver(RunConfig(seed=1), processes=4).uses_worker_processes)
+        # the run stops when the time runs out, keeping the best output so far
+        solver = SubstitutionSolver(RunConfig(time_limit=0.2, target_score=0), processes=1)
+        solver.solver_queue = queue.Queue()
+        solver.run(cipher_text)
+        self.assertLess(time.time() - solver.start_time, 1)
+        self.assertGreater(len(solver.outputs), 0)
+        # brute force solvers stop once an output is better than the target score
+        solver = AffineSolver(RunConfig(target_score=100))
+        solver.solver_queue = queue.Queue()
+        solver.run(cipher_text)
+        self.assertEqual(solver.evaluations, 26)
+
+    def test_staged_search(self):
+        solver = SubstitutionSolver(processes=1)
+        # short texts are only climbed using 4grams
+        scorer, annealer, coarse_annealer = solver.create_search(SAMPLE_TEXT)
+        self.assertIsNone(coarse_annealer)
+        # long texts are climbed using cheaper ngrams first
+        cipher_text = substitution(SAMPLE_TEXT * 30, SAMPLE_MAPPING)
+        scorer, annealer, coarse_annealer = solver.create_search(cipher_text)
+        self.assertEqual(coarse_annealer.scorer.ngram_data.n, 2)
+        solver.start_run()
+        start_score = scorer.score
+        score = solver.improve(scorer, annealer, coarse_annealer)
+        # the scorer is left on the refined mapping
+        self.assertAlmostEqual(score, scorer.score)
+        self.assertLess(score, start_score)
+        self.assertIsNone(SubstitutionSolver(processes=1, staged=False).create_search(cipher_text)[2])
+
+    def test_seed_from_words(self):
+        cipher_text = substitution("The cat and the dog were in the house. She said that they would come back", SAMPLE_MAPPING)
+        solver = SubstitutionSolver(processes=1)
+        scorer, annealer = solver.create_search(cipher_text)[:2]
+        self.assertTrue(solver.seed_from_words(scorer, cipher_text))
+        # the letters of the words are mapped back to themselves, and the mapping is still one to one
+        mapping = codes_to_mapping(scorer.mapping)
+        for letter in "THECANDOGWRISUYLMBK":
+            self.assertEqual(mapping[SAMPLE_MAPPING[letter]], letter)
+        self.assertEqual(sorted(mapping.values()), sorted(mapping.keys()))
+        # the seeded mapping is annealed gently, so it only gets better
+        seeded_score = scorer.score
+        solver.start_run()
+        self.assertLessEqual(solver.improve(scorer, annealer, seeded=True), seeded_score)
+        # long texts aren't seeded, as the search finds their mapping quickly anyway
+        self.assertFalse(solver.seed_from_words(scorer, " ".join([cipher_text] * 10)))
+        # texts without spaces aren't seeded
+        self.assertFalse(solver.seed_from_words(scorer, cipher_text.replace(" ", "")))
+        self.assertFalse(SubstitutionSolver(processes=1, use_word_patterns=False).seed_from_words(scorer, cipher_text))
+
+    def test_best_n_long_key(self):
+        cipher_text = letters_only_uppercase(vigenere(SAMPLE_TEXT, [10, 4, 24]))
+        codes = text_to_codes(cipher_text)
+        for key_len in (2, 3, 5, 6, 7):
+            # score every pair of key letters one position at a time
+            key_possibilities = [[] for _ in range(key_len)]
+            for key_index in range(key_len):
+                best_average, best_key1, best_key2 = float("inf"), 0, 0
+                for key1, key2 in itertools.product(range(26), repeat=2):
+                    scores = [bigram_table[(codes[i] - key1) % 26, (codes[i + 1] - key2) % 26]
+                              for i in range(key_index, len(codes) - 1, key_len)]
+                    total_score = 0
+                    for score in scores:
+                        total_score += score
+                    if total_score / len(scores) < best_average:
+                        best_average, best_key1, best_key2 = total_score / len(scores), key1, key2
+                key_possibilities[key_index].append((chr(65 + best_key1), best_average))
+                key_possibilities[(key_index + 1) % key_len].append((chr(65 + best_key2), best_average))
+            expected = "".join(sorted(possibilities, key=lambda x: x[1])[0][0] for possibilities in key_possibilities)
+            self.assertEqual(best_n_long_key(codes, bigram_table, key_len), expected)
+        self.assertEqual(best_n_long_key(codes, bigram_table, 3), "KEY")
+
+    def test_vigenere_solver(self):
+        # find the keys in this process and in worker processes
+        for processes in (1, 2):
+            solver = VigenereSolver(processes=processes)
+            self.assertEqual(solver.uses_worker_processes, processes > 1)
+            solver.solver_queue = queue.Queue()
+            solver.run(vigenere(SAMPLE_TEXT, [10, 4, 24]))
+            self.assertEqual(solver.outputs[0][1], "KEY")
+            # the most likely lengths are tried first, and the solver stops once the same key is found at two lengths
+            self.assertLess(solver.evaluations, 10)
+            self.assertEqual(solver.solver_queue.queue[-1], ("done", None))
+
+    def test_rank_key_lengths(self):
+        analysis = VigenereAnalysis(text_to_codes(vigenere(SAMPLE_TEXT, [10, 4, 24])))
+        # the columns of the right key length are english letters shifted, so letters repeat more than in random text
+        self.assertGreater(analysis.coincidence(3), analysis.coincidence(4))
+        self.assertEqual(VigenereAnalysis(text_to_codes("AB")).coincidence(5), RANDOM_COINCIDENCE)
+        self.assertEqual(list(kasiski_distances(text_to_codes("ABCDABCXABC"))), [4, 4])
+        self.assertEqual(analysis.rank_key_lengths(list(range(2, 20)))[0], 3)
+        self.assertEqual(shortest_repeat("KEYKEYKEY"), "KEY")
+        self.assertEqual(shortest_repeat("KEYKEX"), "KEYKEX")
+        self.assertEqual(shortest_repeat("AAAA"), "A")
+
+    def test_vigenere_analysis(self):
+        codes = text_to_codes(vigenere(SAMPLE_TEXT, [10, 4, 24]))
+        analysis = VigenereAnalysis(codes)
+        # counts of a period are added up from the counts of a multiple of it
+        analysis.pair_counts(12)
+        analysis.letter_counts(12)
+        for period in (2, 3, 4, 6):
+            self.assertTrue((analysis.pair_counts(period) == analysis.count_pairs(period)).all())
+            self.assertTrue((analysis.letter_counts(period) == analysis.count_letters(period)).all())
+        self.assertEqual(analysis.pair_counts(5).sum(), len(codes) - 1)
+        self.assertEqual(analysis.best_key(3), "KEY")
+        self.assertEqual(analysis.best_key(6), "KEYKEY")
+
+    def test_vigenere_scorer(self):
+        codes = text_to_codes(vigenere(SAMPLE_TEXT, [10, 4, 24]))
+        scorer = VigenereScorer(codes, [10, 4, 23])
+        # the total for each shift of a key letter is the same as re-scoring the whole text with that shift
+        totals = scorer.group_totals(numpy.array([2]))
+        for shift in (0, 23, 24):
+            self.assertAlmostEqual(totals[shift, 0], VigenereScorer(codes, [10, 4, shift]).total_score)
+        scorer.set_letters(numpy.array([2]), [24])
+        self.assertAlmostEqual(scorer.total_score, VigenereScorer(codes, [10, 4, 24]).total_score)
+        self.assertEqual(totals.argmin(), 24)
+        # letters of a group are scored independently of each other
+        key = [10, 4, 24] * 4
+        scorer = VigenereScorer(codes, key)
+        totals = scorer.group_totals(numpy.array([1, 5]))
+        self.assertAlmostEqual(totals[7, 1], VigenereScorer(codes, key[:5] + [7] + key[6:]).total_score)
+        self.assertEqual([list(group) for group in independent_key_indexes(10)], [[0, 4], [1, 5], [2, 6], [3, 7], [8], [9]])
+        self.assertEqual([list(group) for group in independent_key_indexes(3)], [[0], [1], [2]])
+        # a key with wrong letters is climbed to the right key
+        self.assertEqual(refine_key(codes, "KAX"), "KEY")
+        self.assertEqual(refine_key(codes, "KAXKEYKEYKEYEEY"), "KEY" * 5)
+        self.assertEqual(refine_key(codes[:3], "KAX"), "KAX")
+
+    def test_long_vigenere_keys(self):
+        # text made of common words, most common most often, long enough for a key 120 long
+        with open(WORD_LIST_PATH, "r") as f:
+            words = f.read().split()
+        random_generator = random.Random(0)
+        text = " ".join(random_generator.choices(words, [1 / rank for rank in range(1, len(words) + 1)], k=2000))
+        key = [random_generator.randrange(26) for _ in range(120)]
+        cipher_text = vigenere(text, key)
+        analysis = VigenereAnalysis(text_to_codes(cipher_text))
+        # the coincidences at every distance are the same as comparing the letters one at a time
+        codes = list(analysis.codes[:500])
+        small_analysis = VigenereAnalysis(codes)
+        for distance in (1, 2, 120, 499):
+            expected = sum(codes[i] == codes[i + distance] for i in range(len(codes) - distance))
+            self.assertEqual(small_analysis.coincidences()[distance], expected)
+        self.assertEqual(analysis.long_key_lengths(len(analysis.codes) // 5), [120])
+        self.assertEqual(analysis.long_key(120), "".join(chr(65 + shift) for shift in key))
+        # texts with short keys don't have long key lengths
+        self.assertEqual(VigenereAnalysis(text_to_codes(vigenere(text, [10, 4, 24]))).long_key_lengths(1000), [])
+        solver = VigenereSolver()
+        solver.solver_queue = queue.Queue()
+        solver.run(cipher_text)
+        self.assertEqual(solver.outputs[0][0], text)
+        self.assertEqual(decrypt("Héllo, World! zZ", [3, 25, 7]), reverse_vigenere("Héllo, World! zZ", [3, 25, 7]))
+
+    def test_composite_long_vigenere_key(self):
+        # the wrong lengths 6 and 18 both give the same nonsense key 6 long, which mustn't stop the solver before it
+        # tries long keys
+        with open(BOOK_PATH, "r") as f:
+            text = f.read()
+        random_generator = random.Random(1)
+        key = [random_generator.randrange(26) for _ in range(120)]
+        solver = VigenereSolver()
+        solver.solver_queue = queue.Queue()
+        solver.run(vigenere(text, key))
+        self.assertEqual(solver.outputs[0][1], "".join(ascii_uppercase[shift] for shift in key))
+
+    def test_histogram_scoring(self):
+        # the scores from relabeling the ngram counts are the same as decrypting and rating each text
+        cipher_text = caesar(SAMPLE_TEXT, 3)
+        solver = CaesarSolver()
+        solver.solver_queue = queue.Queue()
+        solver.start_run()
+        scores = solver.rate_mappings(ngram_counts(cipher_text), [[(letter - shift) % 26 for letter in range(26)] for shift in range(26)])
+        for shift, score in enumerate(scores):
+            self.assertAlmostEqual(score, rate(caesar(cipher_text, -shift)))
+        self.assertEqual(solver.evaluations, 26)
+        # only the best keys are decrypted into outputs
+        decrypted = []
+        solver.best_possibilities(list(range(26)), scores, lambda shift: decrypted.append(shift) or caesar(cipher_text, -shift))
+        self.assertEqual(len(decrypted), 10)
+        self.assertEqual(solver.outputs[0][:2], (SAMPLE_TEXT, 3))
+        # long and short texts are solved the same way
+        for text in (SAMPLE_TEXT, "It was the best of times"):
+            solver = CaesarSolver()
+            solver.solver_queue = queue.Queue()
+            solver.run(caesar(text, 3))
+            self.assertEqual(solver.outputs[0][:2], (text, 3))
+            self.assertEqual(len(solver.outputs), 10)
+            solver = AffineSolver()
+            solver.solver_queue = queue.Queue()
+            solver.run(affine(text, 5, 8))
+            self.assertEqual(solver.outputs[0][:2], (text, (5, 8)))
+            self.assertEqual(solver.outputs[0][0], reverse_affine(affine(text, 5, 8), 5, 8))
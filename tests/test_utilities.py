@@ -1,6 +1,6 @@
 import unittest
 
-from utilities import extended_euclidean, greatest_common_divisor, mod_inverse, letters_only_uppercase
+from utilities import extended_euclidean, greatest_common_divisor, mod_inverse, letters_only_uppercase, letters_only_uppercase_bytes
 
 
 class TestUtilities(unittest.TestCase):
@@ -35,3 +35,9 @@ class TestUtilities(unittest.TestCase):
 
         self.assertEqual(letters_only_uppercase("1243!@£$"), "")
         self.assertEqual(letters_only_uppercase(""), "")
+
+    def test_letters_only_uppercase_bytes(self):
+        self.assertEqual(letters_only_uppercase_bytes(b"ab 123 cd"), b"ABCD")
+        self.assertEqual(letters_only_uppercase_bytes(b"1243!@$"), b"")
+        for text in ("Hello World", "Caf\u00e9 na\u00efve \u00c5ngstr\u00f6m", "1243!@\u00a3$"):
+            self.assertEqual(letters_only_uppercase_bytes(text.encode("utf-8")), letters_only_uppercase(text).encode("ascii"))
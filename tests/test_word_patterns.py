@@ -0,0 +1,35 @@
+import unittest
+
+from ciphers.substitution import substitution
+from word_patterns import get_word_patterns, partial_key, word_counts, word_pattern
+
+SAMPLE_TEXT = "The cat and the dog were in the house. She said that they would come back with the man."
+SAMPLE_MAPPING = dict(zip("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "QWERTYUIOPASDFGHJKLZXCVBNM"))
+
+
+class TestWordPatterns(unittest.TestCase):
+
+    def test_word_pattern(self):
+        self.assertEqual(word_pattern("HELLO"), "ABCCD")
+        self.assertEqual(word_pattern("THAT"), "ABCA")
+        self.assertEqual(word_pattern("A"), "A")
+
+    def test_word_counts(self):
+        self.assertEqual(word_counts("Don't stop, don't-stop 123"), {"DONT": 2, "STOP": 2})
+
+    def test_candidates(self):
+        candidates = [bytes(65 + code for code in codes).decode() for codes, log_probability in get_word_patterns().candidates("XYX")]
+        # the most common words are first
+        self.assertEqual(candidates[0], "DID")
+        self.assertTrue(all(word_pattern(candidate) == "ABA" for candidate in candidates))
+        self.assertEqual(get_word_patterns().candidates("QQQQQQ"), [])
+
+    def test_partial_key(self):
+        cipher_text = substitution(SAMPLE_TEXT, SAMPLE_MAPPING)
+        key = partial_key(cipher_text)
+        # every letter of the text is pinned down to the right letter
+        self.assertEqual(len(key), len(set(letter for letter in SAMPLE_TEXT.upper() if letter.isalpha())))
+        for cipher_code, plain_code in key.items():
+            self.assertEqual(SAMPLE_MAPPING[chr(65 + plain_code)], chr(65 + cipher_code))
+        # no words, no key
+        self.assertEqual(partial_key("1234"), {})